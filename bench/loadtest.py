@@ -0,0 +1,360 @@
+"""Load test for main.py against local stand-ins for the Bot API and API_BASE_URL.
+
+A child process serves a fake Bot API, a fake downloader API and a media CDN,
+each with configurable latency and error rate. The bot's real handlers, caches,
+scheduler and transfer code run in this process; updates are fed through the
+same update processor the Application uses, so queueing is part of the latency.
+
+    python bench/loadtest.py --requests 500 --rate 50 --users 100
+    python bench/loadtest.py --trace logs/requests.jsonl --rate 0
+
+With --trace, the platforms of a request log written by main.py are replayed in
+order (--rate 0 keeps the original spacing). Without it, --mix picks platforms.
+Outgoing calls go through the bot's own OutboundLimiter, so the OUTBOUND_*
+settings apply here as in production.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+PLATFORMS = (
+    "instagram", "tiktok", "facebook", "x", "youtube", "spotify", "pinterest",
+    "mediafire", "capcut", "threads", "soundcloud", "yt_trans",
+)
+# What the generic mock endpoints hand out, by the extension of the media link
+MOCK_EXTENSIONS = {"spotify": "mp3", "soundcloud": "mp3", "pinterest": "jpg", "threads": "jpg", "mediafire": "zip"}
+
+
+def parse_args(argv: list[str] | None = None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--requests", type=int, help="requests to send (default: 500, or the whole trace)")
+    p.add_argument("--rate", type=float, default=50, help="arrivals per second; 0 = burst, or trace timing with --trace")
+    p.add_argument("--trace", help="JSONL request log to replay")
+    p.add_argument("--mix", default="instagram=1,tiktok=1", help="platform weights without --trace")
+    p.add_argument("--users", type=int, default=100, help="distinct users sending requests")
+    p.add_argument("--distinct-urls", type=int, default=0, help="size of the URL pool; 0 = every URL is new")
+    p.add_argument("--items", type=int, default=3, help="media items per Instagram post")
+    p.add_argument("--media-size", type=int, default=512 * 1024, help="bytes per media file")
+    p.add_argument("--api-latency", type=float, default=0.2, help="seconds per API_BASE_URL call")
+    p.add_argument("--tg-latency", type=float, default=0.03, help="seconds per Bot API call")
+    p.add_argument("--media-latency", type=float, default=0.05, help="seconds before a media download starts")
+    p.add_argument("--error-rate", type=float, default=0.0, help="share of API_BASE_URL calls that fail")
+    p.add_argument("--tg-error-rate", type=float, default=0.0, help="share of Bot API calls that fail")
+    p.add_argument("--tg-flood-rate", type=float, default=0.0, help="share of Bot API calls answered with 429 RetryAfter")
+    p.add_argument("--port", type=int, default=8790)
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    return p.parse_args(argv)
+
+
+# === MOCK SERVERS (child process) ===
+def run_mocks(args):
+    import logging
+
+    import tornado.web
+
+    logging.getLogger("tornado.access").setLevel(logging.CRITICAL)
+
+    base = f"http://127.0.0.1:{args.port}"
+    calls = Counter()
+    message_ids = itertools.count(1)
+    served = {"media_bytes": 0}
+
+    def message(chat_id, **extra):
+        return {"message_id": next(message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    def attachment(kind):
+        file_id = f"{kind}-{random.getrandbits(48):x}"
+        if kind == "photo":
+            return {"photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]}
+        if kind == "video":
+            return {"video": {"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1, "duration": 1}}
+        if kind == "audio":
+            return {"audio": {"file_id": file_id, "file_unique_id": file_id, "duration": 1}}
+        return {"document": {"file_id": file_id, "file_unique_id": file_id}}
+
+    class BotApiHandler(tornado.web.RequestHandler):
+        async def post(self, method):
+            calls[f"tg.{method}"] += 1
+            await asyncio.sleep(args.tg_latency)
+            if method != "getMe" and random.random() < args.tg_error_rate:
+                self.set_status(500)
+                self.write({"ok": False, "error_code": 500, "description": "Internal Server Error: mock"})
+                return
+            if method != "getMe" and random.random() < args.tg_flood_rate:
+                calls["flood_waits"] += 1
+                self.set_status(429)
+                self.write({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                            "parameters": {"retry_after": 1}})
+                return
+            chat_id = int(self.get_body_argument("chat_id", "1"))
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+            elif method in ("sendPhoto", "sendVideo", "sendAudio", "sendDocument"):
+                result = message(chat_id, **attachment(method[4:].lower()))
+            elif method == "sendMediaGroup":
+                media = json.loads(self.get_body_argument("media", "[]"))
+                result = [message(chat_id, **attachment(item["type"])) for item in media]
+            elif method in ("sendMessage", "editMessageText"):
+                result = message(chat_id, text=self.get_body_argument("text", ""))
+            else:
+                result = True
+            self.write({"ok": True, "result": result})
+
+    class ApiHandler(tornado.web.RequestHandler):
+        async def get(self, endpoint):
+            calls[f"api.{endpoint}"] += 1
+            await asyncio.sleep(args.api_latency)
+            if random.random() < args.error_rate:
+                self.set_status(502)
+                return
+            tag = random.getrandbits(48)
+            if endpoint == "insta":
+                urls = [f"{base}/media/{args.media_size}-{tag:x}-{i}.{'mp4' if i == 0 else 'jpg'}" for i in range(args.items)]
+                self.write({"success": True, "urls": urls})
+            elif endpoint == "tiktok":
+                link = f"{base}/media/{args.media_size}-{tag:x}.mp4"
+                self.write({"success": True, "data": [{"title": "Bench video", "downloadLinks": [{"link": link}]}]})
+            elif endpoint == "yt_trans":
+                self.write({"success": True, "transcript": "bench transcript " * 50})
+            else:
+                link = f"{base}/media/{args.media_size}-{tag:x}.{MOCK_EXTENSIONS.get(endpoint, 'mp4')}"
+                self.write({"success": True, "data": {"title": "Bench media", "url": link}})
+
+    class MediaHandler(tornado.web.RequestHandler):
+        def set_default_headers(self):
+            self.set_header("Content-Type", "application/octet-stream")
+
+        def head(self, size):
+            self.set_header("Content-Length", size)
+
+        async def get(self, size):
+            calls["media"] += 1
+            await asyncio.sleep(args.media_latency)
+            remaining = int(size)
+            self.set_header("Content-Length", str(remaining))
+            chunk = b"\0" * 65536
+            while remaining:
+                part = chunk[:min(remaining, len(chunk))]
+                self.write(part)
+                await self.flush()
+                remaining -= len(part)
+            served["media_bytes"] += int(size)
+
+    class StatsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.write({"calls": dict(calls), **served})
+
+    async def serve():
+        app = tornado.web.Application([
+            (r"/bot[^/]+/(\w+)", BotApiHandler),
+            (r"/api/(\w+)", ApiHandler),
+            (r"/media/(\d+)-.*", MediaHandler),
+            (r"/_stats", StatsHandler),
+        ])
+        app.listen(args.port, "127.0.0.1", max_body_size=1024 * 1024 * 1024)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+# === WORKLOAD ===
+def load_trace(path: str) -> list[tuple[float | None, str]]:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            platform = record.get("platform") or record.get("command")
+            if platform in PLATFORMS:
+                ts = record.get("ts")
+                records.append((datetime.fromisoformat(ts).timestamp() if ts else None, platform))
+    return records
+
+
+def build_workload(args) -> list[tuple[float, str]]:
+    """(offset in seconds, platform) for every request to send."""
+    if args.trace:
+        trace = load_trace(args.trace)
+        if not trace:
+            sys.exit(f"No replayable records in {args.trace}")
+        if args.requests is not None:
+            trace = list(itertools.islice(itertools.cycle(trace), args.requests))
+        first = trace[0][0]
+        if not args.rate and first is not None:
+            return [(max((ts or first) - first, 0), platform) for ts, platform in trace]
+        platforms = [platform for _, platform in trace]
+    else:
+        weights = dict((k.strip(), float(v)) for k, v in (x.split("=", 1) for x in args.mix.split(",")))
+        unknown = set(weights) - set(PLATFORMS)
+        if unknown:
+            sys.exit(f"Unknown platforms in --mix: {', '.join(sorted(unknown))}")
+        platforms = random.choices(list(weights), list(weights.values()), k=args.requests or 500)
+    return [(i / args.rate if args.rate else 0, platform) for i, platform in enumerate(platforms)]
+
+
+def make_update(update_id: int, user_id: int, platform: str, url: str) -> dict:
+    text = f"/{platform} {url}"
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(platform) + 1}],
+        },
+    }
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+# === DRIVER ===
+async def drive(args, workload):
+    import httpx
+    from telegram import Update
+
+    import main
+
+    # Updates are fed straight to the application, as in webhook mode
+    app = main.build_application(polling=False)
+
+    latencies: list[float] = []
+    failures = Counter()
+
+    async def one(update: Update):
+        started = time.perf_counter()
+        try:
+            await app.update_processor.process_update(update, app.process_update(update))
+        except Exception as e:
+            failures[type(e).__name__] += 1
+        latencies.append(time.perf_counter() - started)
+
+    async with app:
+        await main.post_init(app)
+        try:
+            before = dict(main.stats.counters)
+            url_ids = itertools.count()
+            tasks = []
+            started = time.perf_counter()
+            for update_id, (offset, platform) in enumerate(workload, 1):
+                delay = started + offset - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                n = random.randrange(args.distinct_urls) if args.distinct_urls else next(url_ids)
+                user_id = 1000 + update_id % args.users
+                data = make_update(update_id, user_id, platform, f"https://{platform}.example/p/{n}")
+                tasks.append(asyncio.create_task(one(Update.de_json(data, app.bot))))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+            outcomes = {k: main.stats.counters[k] - before.get(k, 0) for k in main.stats.counters}
+            coalesced = main.api_flight.coalesced + main.media_flight.coalesced
+        finally:
+            await main.post_shutdown(app)
+
+    async with httpx.AsyncClient() as client:
+        mock = (await client.get(f"http://127.0.0.1:{args.port}/_stats")).json()
+    return elapsed, latencies, failures, outcomes, coalesced, mock
+
+
+def report(args, workload, elapsed, latencies, failures, outcomes, coalesced, mock) -> dict:
+    n = len(workload)
+    tg_calls = {k[3:]: v for k, v in mock["calls"].items() if k.startswith("tg.") and k != "tg.getMe"}
+    return {
+        "requests": n,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(n / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "max": round(max(latencies, default=0) * 1000, 1),
+        },
+        "outcomes": {**outcomes, **{f"exception.{k}": v for k, v in failures.items()}},
+        # ru_maxrss is in KiB on Linux; only this process, the mocks run in a child
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "telegram_calls_per_request": round(sum(tg_calls.values()) / n, 2),
+        "telegram_calls": dict(sorted(tg_calls.items())),
+        "telegram_flood_waits": mock["calls"].get("flood_waits", 0),
+        "api_calls": sum(v for k, v in mock["calls"].items() if k.startswith("api.")),
+        "media_downloads": mock["calls"].get("media", 0),
+        "media_mb_served": round(mock["media_bytes"] / 1024 / 1024, 1),
+        "coalesced_calls": coalesced,
+    }
+
+
+def print_report(r: dict):
+    lat = r["latency_ms"]
+    print(f"Requests:        {r['requests']} in {r['elapsed_s']}s ({r['throughput_rps']} req/s)")
+    print(f"Latency (ms):    p50 {lat['p50']}  p95 {lat['p95']}  p99 {lat['p99']}  max {lat['max']}")
+    print("Outcomes:        " + ", ".join(f"{k}={v}" for k, v in r["outcomes"].items()))
+    print(f"Peak RSS:        {r['peak_rss_mb']} MB")
+    print(f"Telegram calls:  {r['telegram_calls_per_request']} per request " + str(r["telegram_calls"]))
+    print(f"Flood waits:     {r['telegram_flood_waits']}")
+    print(f"Upstream:        {r['api_calls']} API calls, {r['media_downloads']} downloads, {r['media_mb_served']} MB, {r['coalesced_calls']} coalesced")
+
+
+def main():
+    args = parse_args()
+    workload = build_workload(args)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    base = f"http://127.0.0.1:{args.port}"
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "BOT_API_URL": base,
+        "API_BASE_URL": f"{base}/api",
+        "DB_PATH": os.path.join(workdir, "bot.db"),
+        "REQUEST_LOG_PATH": os.path.join(workdir, "requests.jsonl"),
+        "COOLDOWN": "0",
+        "GLOBAL_RATE_LIMIT": "0",
+        "HTTP2": "0",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    mocks = multiprocessing.Process(target=run_mocks, args=(args,), daemon=True)
+    mocks.start()
+    try:
+        wait_for_port(args.port)
+        results = asyncio.run(drive(args, workload))
+    finally:
+        mocks.terminate()
+    r = report(args, workload, *results)
+    if args.json:
+        print(json.dumps(r, indent=2))
+    else:
+        print_report(r)
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    import socket
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    sys.exit(f"Mock servers did not start on port {port}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Micro-benchmarks for the hot paths of main.py, with allocation peaks.
+
+Runs against the same local stand-ins as loadtest.py (started in a child
+process with zero latency), so the numbers are the bot's own overhead.
+
+    python bench/microbench.py --save bench/baseline.json
+    python bench/microbench.py --compare bench/baseline.json --tolerance 20
+
+--compare exits non-zero when any benchmark got slower or allocates more
+than the tolerance (in percent), so it can gate a deploy.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from loadtest import make_update, run_mocks, wait_for_port
+from loadtest import parse_args as loadtest_args
+
+MB = 1000 * 1000
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--sizes", default="1,10,50", help="send_media_from_url payloads in MB")
+    p.add_argument("--spinner-chats", type=int, default=20, help="concurrent status messages in the spinner benchmark")
+    p.add_argument("--spinner-seconds", type=float, default=6, help="how long the spinner benchmark runs")
+    p.add_argument("--port", type=int, default=8791)
+    p.add_argument("--save", help="write results to this JSON file")
+    p.add_argument("--compare", help="baseline JSON file to compare against")
+    p.add_argument("--tolerance", type=float, default=20, help="allowed regression in percent")
+    return p.parse_args()
+
+
+def measure_sync(name: str, fn, number: int, repeat: int = 5) -> dict:
+    best = min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+    tracemalloc.start()
+    for _ in range(number):
+        fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"name": name, "ops": number, "us_per_op": best * 1e6, "peak_kib": peak / 1024}
+
+
+async def measure_async(name: str, make_call, number: int, repeat: int = 3) -> dict:
+    # make_call() returns a fresh coroutine, so each op can use new inputs
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            await make_call()
+        timings.append((time.perf_counter() - started) / number)
+    tracemalloc.start()
+    for _ in range(number):
+        await make_call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"name": name, "ops": number, "us_per_op": min(timings) * 1e6, "peak_kib": peak / 1024}
+
+
+async def run(args, base: str) -> list[dict]:
+    import httpx
+    from telegram import Bot, Update
+
+    import main
+
+    bot = Bot(main.BOT_TOKEN, base_url=f"{base}/bot", base_file_url=f"{base}/file/bot")
+    await bot.initialize()
+    await main.post_init(None)
+    results = []
+    ids = itertools.count(1)
+    users = itertools.cycle(range(1000))
+
+    def update(user_id: int = 1) -> Update:
+        return Update.de_json(make_update(next(ids), user_id, "tiktok", "https://tiktok.example/p/1"), bot)
+
+    # A failing call is usually a fast one, so it must stop the run rather than pass as a good number
+    async def lookup(url: str):
+        result = await main.call_api("tiktok", url)
+        if not result.get("success"):
+            raise RuntimeError(f"call_api failed for {url}: {result.get('error')}")
+
+    def rate_limit(expect_limited: bool):
+        limited, _ = main.check_rate_limit(next(users), "tiktok")
+        if limited != expect_limited:
+            raise RuntimeError(f"check_rate_limit {'admitted' if expect_limited else 'rejected'} a call it should not have")
+
+    async def send(media_url: str, source_url: str):
+        if not await main.send_media_from_url(update(), media_url, "video", source_url=source_url):
+            raise RuntimeError(f"send_media_from_url failed for {media_url}; see the log above")
+
+    try:
+        # Buckets that refill faster than the loop can drain them, so every call takes the admitted path
+        main.rate_limiter = main.RateLimiter(1e9, 1e9, 1e9, 1e9, main.RATE_LIMIT_MAX_USERS)
+        results.append(measure_sync("check_rate_limit", lambda: rate_limit(False), 20000))
+        # And buckets that are already empty, so every call is turned away
+        main.rate_limiter = main.RateLimiter(1e-9, 1, 0, 0, main.RATE_LIMIT_MAX_USERS)
+        for user_id in range(1000):
+            main.check_rate_limit(user_id, "tiktok")
+        results.append(measure_sync("check_rate_limit (rejected)", lambda: rate_limit(True), 20000))
+        results.append(measure_sync("track_command", lambda: main.track_command(next(users), "tiktok", True), 20000))
+
+        await lookup("https://tiktok.example/p/cached")
+        results.append(await measure_async("call_api (cached)", lambda: lookup("https://tiktok.example/p/cached"), 5000))
+        urls = (f"https://tiktok.example/p/{i}" for i in itertools.count())
+        results.append(await measure_async("call_api (local stub)", lambda: lookup(next(urls)), 300))
+
+        for size in (int(s) for s in args.sizes.split(",")):
+            media_url = f"{base}/media/{size * MB}-bench.mp4"
+            sources = (f"https://tiktok.example/v/{size}-{i}" for i in itertools.count())
+            results.append(await measure_async(
+                f"send_media_from_url ({size} MB)",
+                lambda: send(media_url, next(sources)),
+                3 if size >= 10 else 10,
+            ))
+
+        results.append(await spinner_rate(args, bot, base, httpx))
+    finally:
+        await main.post_shutdown(None)
+        await bot.shutdown()
+    return results
+
+
+async def spinner_rate(args, bot, base: str, httpx) -> dict:
+    """Status edits per second with many transfers reporting progress at once."""
+    import main
+
+    async with httpx.AsyncClient() as client:
+        before = (await client.get(f"{base}/_stats")).json()["calls"].get("tg.editMessageText", 0)
+        messages = [await bot.send_message(chat_id, "⏳ Processing...") for chat_id in range(1, args.spinner_chats + 1)]
+        reporters = [main.ProgressReporter(msg) for msg in messages]
+        for reporter in reporters:
+            reporter.add_total(100 * MB)
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.spinner_seconds:
+            for reporter in reporters:
+                reporter.advance(MB)
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        for reporter in reporters:
+            reporter.stop()
+        edits = (await client.get(f"{base}/_stats")).json()["calls"].get("tg.editMessageText", 0) - before
+    return {"name": f"status edits ({args.spinner_chats} chats)", "ops": edits, "edits_per_s": edits / elapsed}
+
+
+def print_results(results: list[dict], baseline: dict[str, dict] | None, tolerance: float) -> bool:
+    regressed = False
+    print(f"{'benchmark':<30} {'ops':>7} {'us/op':>12} {'peak KiB':>10}  change")
+    for r in results:
+        if "edits_per_s" in r:
+            print(f"{r['name']:<30} {r['ops']:>7} {r['edits_per_s']:>9.2f}/s")
+            continue
+        change = ""
+        old = (baseline or {}).get(r["name"])
+        if old:
+            dt = (r["us_per_op"] / old["us_per_op"] - 1) * 100
+            dm = (r["peak_kib"] / max(old["peak_kib"], 1) - 1) * 100
+            change = f"time {dt:+.0f}%, memory {dm:+.0f}%"
+            if dt > tolerance or dm > tolerance:
+                change += "  REGRESSION"
+                regressed = True
+        print(f"{r['name']:<30} {r['ops']:>7} {r['us_per_op']:>12.1f} {r['peak_kib']:>10.1f}  {change}")
+    return regressed
+
+
+def main():
+    args = parse_args()
+    base = f"http://127.0.0.1:{args.port}"
+    workdir = tempfile.mkdtemp(prefix="microbench-")
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "BOT_API_URL": base,
+        "API_BASE_URL": f"{base}/api",
+        "DB_PATH": os.path.join(workdir, "bot.db"),
+        "REQUEST_LOG_PATH": "",
+        "HTTP2": "0",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    # Start from the load test's defaults so every mock option is set, then take out the latency
+    mock_args = loadtest_args([])
+    vars(mock_args).update(port=args.port, api_latency=0, tg_latency=0, media_latency=0, items=1, media_size=1024)
+    mocks = multiprocessing.Process(target=run_mocks, args=(mock_args,), daemon=True)
+    mocks.start()
+    try:
+        wait_for_port(args.port)
+        results = asyncio.run(run(args, base))
+    finally:
+        mocks.terminate()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = {r["name"]: r for r in json.load(f)}
+    regressed = print_results(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
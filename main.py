@@ -1,112 +1,1834 @@
 import logging
-import requests
 import asyncio
 import re
+import html
 import time
-from datetime import datetime
+import json
+import random
+import gzip
+import hmac
+import signal
+import heapq
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import shutil
+import functools
+import importlib.util
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from uuid import uuid4
+from datetime import datetime, timedelta
+from typing import Any
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 import os
 
-from telegram import Update
-from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, CallbackContext
+import httpx
+import tornado.web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from telegram import InputFile, InputMediaPhoto, InputMediaVideo, Message, Update
+from telegram.constants import MessageEntityType, ParseMode
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackContext, MessageHandler, filters
 
 # === CONFIGURATION FROM ENVIRONMENT VARIABLES ===
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 API_BASE_URL = os.getenv("API_BASE_URL", "https://socialdown.itz-ashlynn.workers.dev")
-COMMAND_COOLDOWN = int(os.getenv("COOLDOWN", "7"))
+# Point at a self-hosted Bot API server (or a local stand-in) instead of api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")
+# Each user may send RATE_LIMIT_BURST commands back to back, then one per COOLDOWN seconds; 0 disables
+COMMAND_COOLDOWN = float(os.getenv("COOLDOWN", "7"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "3"))
+# Token cost per command, e.g. "youtube=3,pinterest=0.5"; unlisted commands cost 1
+COMMAND_COSTS = {"youtube": 2, "yt_trans": 2, "spotify": 2, "soundcloud": 2, "mediafire": 2, "pinterest": 0.5}
+COMMAND_COSTS.update(
+    {k.strip(): float(v) for k, v in (x.split("=", 1) for x in os.getenv("COMMAND_COSTS", "").split(",") if "=" in x)}
+)
+# Commands per second admitted across all users, protecting API_BASE_URL; 0 disables
+GLOBAL_RATE_LIMIT = float(os.getenv("GLOBAL_RATE_LIMIT", "20"))
+GLOBAL_RATE_BURST = float(os.getenv("GLOBAL_RATE_BURST", "40"))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "100000"))
+# Outgoing Bot API calls: Telegram allows about 30 messages/s overall, about one
+# per second in a private chat (short bursts are fine) and 20 per minute in a group
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "5"))
+OUTBOUND_GROUP_RATE_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_RATE_PER_MINUTE", "20"))
+# How often a call rejected with 429 RetryAfter is tried again before the error surfaces
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
 ADMIN_IDS = [int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()]
 PORT = int(os.getenv("PORT", 8000))
+# Public base URL of this service; when set, updates arrive by webhook on PORT instead of polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/webhook"
+# Updates handled at the same time, overall and per user; the rest wait in a fair queue
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+MAX_CONCURRENT_PER_USER = int(os.getenv("MAX_CONCURRENT_PER_USER", "2"))
+MAX_QUEUED_UPDATES = int(os.getenv("MAX_QUEUED_UPDATES", "1000"))
+# Requests slower than this log their full span tree; 0 disables the slow-request log
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "20"))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP2_ENABLED = os.getenv("HTTP2", "1") == "1"
+MEDIA_MAX_CONNECTIONS = int(os.getenv("MEDIA_MAX_CONNECTIONS", "50"))
+# Downloads stay in RAM up to this many bytes, then spill to a temp file on disk
+SPOOL_MEMORY_LIMIT = int(os.getenv("SPOOL_MEMORY_LIMIT", str(2 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Bytes that in-flight media downloads and uploads may hold at once; new transfers wait beyond it
+TRANSFER_BUDGET_BYTES = int(os.getenv("TRANSFER_BUDGET_BYTES", str(200 * 1024 * 1024)))
+# How many items of one carousel are downloaded at the same time
+CAROUSEL_CONCURRENCY = int(os.getenv("CAROUSEL_CONCURRENCY", "4"))
+# Albums hold at most 10 items; the byte cap keeps one album's upload bounded in RAM
+MEDIA_GROUP_SIZE = 10
+MEDIA_GROUP_MAX_BYTES = int(os.getenv("MEDIA_GROUP_MAX_BYTES", str(50 * 1024 * 1024)))
+# Status messages are edited at most once per this many seconds per chat,
+# and at most PROGRESS_EDITS_PER_SECOND times per second across all chats
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "2"))
+PROGRESS_EDITS_PER_SECOND = float(os.getenv("PROGRESS_EDITS_PER_SECOND", "5"))
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+# Statistics are kept in memory and written to DB_PATH this often
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "10"))
+# One JSON line per handled command; empty disables the request log
+REQUEST_LOG_PATH = os.getenv("REQUEST_LOG_PATH", "logs/requests.jsonl")
+REQUEST_LOG_BATCH_SIZE = int(os.getenv("REQUEST_LOG_BATCH_SIZE", "200"))
+REQUEST_LOG_FLUSH_INTERVAL = float(os.getenv("REQUEST_LOG_FLUSH_INTERVAL", "5"))
+# The live file is gzipped away past this size; only the newest REQUEST_LOG_BACKUPS archives are kept
+REQUEST_LOG_MAX_BYTES = int(os.getenv("REQUEST_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+REQUEST_LOG_BACKUPS = int(os.getenv("REQUEST_LOG_BACKUPS", "10"))
+# Broadcast sends in flight at once (the outbound limiter sets the actual pace),
+# users per saved cursor step, and seconds between status message updates
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "30"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+# Links handled from one plain message; the rest are ignored
+LINKS_PER_MESSAGE = int(os.getenv("LINKS_PER_MESSAGE", "5"))
+# Where short links (vm.tiktok.com, pin.it, ...) lead is remembered this long
+SHORT_LINK_CACHE_SIZE = int(os.getenv("SHORT_LINK_CACHE_SIZE", "10000"))
+SHORT_LINK_CACHE_TTL = int(os.getenv("SHORT_LINK_CACHE_TTL", str(7 * 24 * 3600)))
+SHORT_LINK_TIMEOUT = float(os.getenv("SHORT_LINK_TIMEOUT", "5"))
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "20000"))
+FILE_ID_CACHE_TTL = int(os.getenv("FILE_ID_CACHE_TTL", str(30 * 24 * 3600)))
+# Persistent caches keep changes in memory and write them to DB_PATH this often
+CACHE_FLUSH_INTERVAL = float(os.getenv("CACHE_FLUSH_INTERVAL", "5"))
+API_CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", "5000"))
+API_CACHE_TTL = float(os.getenv("API_CACHE_TTL", "300"))
+# Per-endpoint overrides, e.g. "insta=600,tiktok=900"; 0 disables caching for that endpoint
+API_CACHE_TTLS = {
+    k.strip(): float(v) for k, v in (x.split("=", 1) for x in os.getenv("API_CACHE_TTLS", "").split(",") if "=" in x)
+}
+API_CACHE_NEGATIVE_TTL = float(os.getenv("API_CACHE_NEGATIVE_TTL", "30"))
+API_CACHE_PERSIST = os.getenv("API_CACHE_PERSIST", "0") == "1"
+# One call_api lookup may take API_DEADLINE seconds in total, spread over up to
+# 1 + API_RETRIES attempts of at most API_ATTEMPT_TIMEOUT each
+API_DEADLINE = float(os.getenv("API_DEADLINE", "30"))
+API_ATTEMPT_TIMEOUT = float(os.getenv("API_ATTEMPT_TIMEOUT", "12"))
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "3"))
+API_RETRIES = int(os.getenv("API_RETRIES", "2"))
+# Retries wait a random time up to API_RETRY_BACKOFF * 2^attempt, capped at API_RETRY_MAX_DELAY
+API_RETRY_BACKOFF = float(os.getenv("API_RETRY_BACKOFF", "0.5"))
+API_RETRY_MAX_DELAY = float(os.getenv("API_RETRY_MAX_DELAY", "4"))
+# A second, identical request is sent once an attempt runs past the endpoint's p95
+# latency; whichever answers first wins. Needs API_HEDGE_MIN_SAMPLES latencies first.
+API_HEDGE = os.getenv("API_HEDGE", "1") == "1"
+API_HEDGE_MIN_SAMPLES = int(os.getenv("API_HEDGE_MIN_SAMPLES", "20"))
+API_HEDGE_MIN_DELAY = float(os.getenv("API_HEDGE_MIN_DELAY", "0.1"))
+# Hedges in flight at once; when upstream is slow for everybody, hedging would only double the load
+API_HEDGE_MAX_IN_FLIGHT = int(os.getenv("API_HEDGE_MAX_IN_FLIGHT", "10"))
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN is missing! Set it in environment variables.")
 
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; derived from the token by default
+# so every replica agrees on it without extra configuration
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# Telegram and health checks hit the web server constantly; only log failures
+logging.getLogger("tornado.access").setLevel(logging.WARNING)
+
+# === TRACING ===
+class Span:
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.children: list[Span] = []
+        self.start = time.perf_counter()
+        self.end: float | None = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def finish(self, **attrs):
+        self.attrs.update(attrs)
+        self.end = time.perf_counter()
+
+    def render(self, depth: int = 0) -> str:
+        attrs = " ".join(f"{k}={v}" for k, v in self.attrs.items())
+        state = "" if self.end is not None else " (unfinished)"
+        lines = [f"{'  ' * depth}{self.name} {self.duration * 1000:.0f}ms{state} {attrs}".rstrip()]
+        lines.extend(child.render(depth + 1) for child in self.children)
+        return "\n".join(lines)
+
+# The innermost open span of the current request; tasks started inside a request
+# (prefetches, the progress reporter) inherit it and attach their spans there
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+current_request_id: ContextVar[str] = ContextVar("current_request_id", default="-")
+# Root span of the current request, where the outcome and the request log fields are recorded
+request_span: ContextVar[Span | None] = ContextVar("request_span", default=None)
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = current_request_id.get()
+        return True
 
-# Statistics
-stats = {
-    "total_requests": 0,
-    "successful_requests": 0,
-    "failed_requests": 0,
-    "users": set(),
-    "commands_used": {},
-    "start_time": datetime.now()
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(RequestIdFilter())
+
+def start_span(name: str, **attrs) -> Span:
+    span = Span(name, attrs)
+    parent = current_span.get()
+    if parent is not None:
+        parent.children.append(span)
+    return span
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    span = start_span(name, **attrs)
+    token = current_span.set(span)
+    try:
+        yield span
+    finally:
+        span.finish()
+        current_span.reset(token)
+
+def walk_spans(span: Span):
+    yield span
+    for child in span.children:
+        yield from walk_spans(child)
+
+def request_record(request_id: str, update: Update, platform: str | None, url: str | None, root: Span) -> dict:
+    stages: dict[str, float] = {}
+    for span in walk_spans(root):
+        if span is not root:
+            stages[span.name] = stages.get(span.name, 0) + span.duration
+    text = update.message.text if update.message and update.message.text else ""
+    return {
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "request_id": request_id,
+        "user": update.effective_user.id,
+        "command": text.split(maxsplit=1)[0].split("@")[0].lstrip("/") if text.startswith("/") else None,
+        "platform": platform,
+        "url_hash": hashlib.sha256(canonical_url(url).encode()).hexdigest()[:16] if url else None,
+        "outcome": root.attrs.get("outcome", "none"),
+        "duration_ms": round(root.duration * 1000, 1),
+        "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in stages.items()},
+        "bytes": sum(span.attrs.get("bytes") or 0 for span in walk_spans(root)),
+    }
+
+def traced(command: str, platform: bool = True):
+    # Gives each handled command a request id and a root span; slow ones dump the tree.
+    # Commands that aren't a platform have no link: their records log platform and url_hash as null
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: CallbackContext, *args):
+            # args[0], when given, is the link to handle instead of the command argument
+            url = (args[0] if args else context.args[0] if context.args else None) if platform else None
+            request_id = uuid4().hex[:8]
+            id_token = current_request_id.set(request_id)
+            try:
+                with trace_span(command, user=update.effective_user.id) as root:
+                    root_token = request_span.set(root)
+                    try:
+                        result = await handler(update, context, *args)
+                        if not platform:
+                            root.attrs.setdefault("outcome", "success")
+                        return result
+                    except Exception:
+                        root.attrs["outcome"] = "error"
+                        raise
+                    finally:
+                        request_span.reset(root_token)
+            finally:
+                if SLOW_REQUEST_SECONDS and root.duration > SLOW_REQUEST_SECONDS:
+                    logger.warning(f"Slow request ({root.duration:.1f}s):\n{root.render()}")
+                if request_log is not None:
+                    request_log.write(request_record(request_id, update, command if platform else None, url, root))
+                current_request_id.reset(id_token)
+        return wrapper
+    return decorator
+
+# Telegram Bot API upload limits
+MEDIA_LIMITS = {
+    "video": 50 * 1024 * 1024,
+    "audio": 50 * 1024 * 1024,
+    "photo": 10 * 1024 * 1024,
+    "document": 50 * 1024 * 1024,
 }
 
+# Shared keep-alive client for API_BASE_URL, owned by the Application lifecycle.
+# Every call_api request goes to the same host, so the pool limit is the per-host limit.
+api_client: httpx.AsyncClient | None = None
+# Separate pool for media CDNs so large downloads never starve API lookups
+media_client: httpx.AsyncClient | None = None
+
+class MediaTooLarge(ValueError):
+    pass
+
+class NotMedia(ValueError):
+    pass
+
+class _ReplyFailed(Exception):
+    """Sending to the leader's own chat failed; the download itself was fine."""
+
+class LRUCache:
+    """Bounded LRU mapping with per-entry expiry and optional SQLite persistence.
+
+    Everything is served from memory; the table is only read once at startup.
+    set/delete/expiry just record the change, and changes are written behind in
+    one transaction per flush from a worker thread.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl: float, db_path: str | None = None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._table = f"cache_{name}"
+        self._db = None
+        self._lock = threading.Lock()
+        # key -> (json value, expires_at, stored_at) to upsert, or None to delete
+        self._pending: dict[str, tuple[str, float, float] | None] = {}
+        if db_path:
+            self._db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self._load()
+
+    def _load(self):
+        now = time.time()
+        self._db.execute(f"DELETE FROM {self._table} WHERE expires_at <= ?", (now,))
+        rows = self._db.execute(
+            f"SELECT key, value, expires_at FROM {self._table} ORDER BY stored_at DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for key, value, expires_at in reversed(rows):
+            self._data[key] = (expires_at, json.loads(value))
+        # Drop whatever no longer fits, e.g. after max_entries was lowered
+        self._db.execute(
+            f"DELETE FROM {self._table} WHERE key NOT IN "
+            f"(SELECT key FROM {self._table} ORDER BY stored_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+    def get(self, key: str) -> Any | None:
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                self.delete(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float | None = None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        if self._db is not None:
+            self._pending[key] = (json.dumps(value), expires_at, now)
+        while len(self._data) > self.max_entries:
+            evicted, _ = self._data.popitem(last=False)
+            if self._db is not None:
+                self._pending[evicted] = None
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+        if self._db is not None:
+            self._pending[key] = None
+
+    def _take_pending(self) -> dict:
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def _write(self, pending: dict):
+        if not pending:
+            return
+        upserts = [(key, *row) for key, row in pending.items() if row is not None]
+        deletes = [(key,) for key, row in pending.items() if row is None]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    f"INSERT OR REPLACE INTO {self._table} (key, value, expires_at, stored_at) VALUES (?, ?, ?, ?)", upserts
+                )
+                self._db.executemany(f"DELETE FROM {self._table} WHERE key = ?", deletes)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        pending = self._take_pending()
+        try:
+            await asyncio.to_thread(self._write, pending)
+        except sqlite3.Error:
+            # Keep the changes for the next flush; anything changed since is newer
+            for key, row in pending.items():
+                self._pending.setdefault(key, row)
+            raise
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(CACHE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"Cache {self.name} flush failed: {e}")
+
+    def __contains__(self, key: str) -> bool:
+        # Membership test that doesn't count towards hits/misses or recency
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.time()
+
+    @property
+    def persistent(self) -> bool:
+        return self._db is not None
+
+    def hit_ratio(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def close(self):
+        if self._db is not None:
+            self._write(self._take_pending())
+            self._db.close()
+            self._db = None
+
+class _LeaderCancelled(Exception):
+    pass
+
+class SingleFlight:
+    """Run at most one call per key; concurrent callers with the same key share its result."""
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, fn):
+        while key in self._calls:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(self._calls[key])
+            except _LeaderCancelled:
+                # The caller doing the work went away; take over instead of failing
+                continue
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except BaseException as e:
+            future.set_exception(_LeaderCancelled() if isinstance(e, asyncio.CancelledError) else e)
+            future.exception()  # mark retrieved; the leader re-raises it anyway
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+api_flight = SingleFlight()
+media_flight = SingleFlight()
+link_flight = SingleFlight()
+
+class StatsStore:
+    """Request statistics and the user list, persisted to SQLite in WAL mode.
+
+    track() only updates memory. Deltas are written behind in one transaction per
+    flush, and the user list is never loaded, only counted once at startup.
+    """
+
+    COUNTERS = ("total_requests", "successful_requests", "failed_requests")
+
+    def __init__(self, db_path: str):
+        self.start_time = datetime.now()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS stats_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS stats_commands (command TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_seen REAL NOT NULL)")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(users)")}
+        if "blocked_at" not in columns:
+            # Set when a broadcast finds the user blocked the bot, cleared when they come back
+            self._db.execute("ALTER TABLE users ADD COLUMN blocked_at REAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts (id INTEGER PRIMARY KEY, text TEXT NOT NULL, status TEXT NOT NULL, "
+            "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, cursor INTEGER NOT NULL DEFAULT -1, "
+            "sent INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, blocked INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL)"
+        )
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.counters.update(self._db.execute("SELECT name, value FROM stats_counters").fetchall())
+        self.commands: dict[str, int] = dict(self._db.execute("SELECT command, count FROM stats_commands").fetchall())
+        self.user_total = self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        self._counter_deltas: dict[str, int] = {}
+        self._command_deltas: dict[str, int] = {}
+        self._new_users: set[int] = set()
+
+    def __getattr__(self, name: str) -> int:
+        # stats.total_requests etc.
+        if name in self.COUNTERS:
+            return self.counters[name]
+        raise AttributeError(name)
+
+    def track(self, user_id: int, cmd: str, success: bool):
+        result = "successful_requests" if success else "failed_requests"
+        for name in ("total_requests", result):
+            self.counters[name] += 1
+            self._counter_deltas[name] = self._counter_deltas.get(name, 0) + 1
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+        self._command_deltas[cmd] = self._command_deltas.get(cmd, 0) + 1
+        self._new_users.add(user_id)
+
+    def _take_pending(self) -> tuple[dict, dict, set]:
+        # Swapped out on the event loop so the writer thread never sees a dict being mutated
+        pending = (self._counter_deltas, self._command_deltas, self._new_users)
+        self._counter_deltas, self._command_deltas, self._new_users = {}, {}, set()
+        return pending
+
+    def _restore_pending(self, counters: dict, commands: dict, users: set):
+        # A failed write is merged back into whatever was tracked since, for the next flush
+        for name, delta in counters.items():
+            self._counter_deltas[name] = self._counter_deltas.get(name, 0) + delta
+        for cmd, delta in commands.items():
+            self._command_deltas[cmd] = self._command_deltas.get(cmd, 0) + delta
+        self._new_users |= users
+
+    def _write(self, counters: dict, commands: dict, users: set) -> int:
+        """Write one batch of deltas; returns how many of the users were new."""
+        if not (counters or commands or users):
+            return 0
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT INTO stats_counters (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    counters.items(),
+                )
+                self._db.executemany(
+                    "INSERT INTO stats_commands (command, count) VALUES (?, ?) "
+                    "ON CONFLICT(command) DO UPDATE SET count = count + excluded.count",
+                    commands.items(),
+                )
+                before = self._db.total_changes
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO users (user_id, first_seen) VALUES (?, ?)",
+                    ((user_id, now) for user_id in users),
+                )
+                added = self._db.total_changes - before
+                self._db.executemany(
+                    "UPDATE users SET blocked_at = NULL WHERE user_id = ? AND blocked_at IS NOT NULL",
+                    ((user_id,) for user_id in users),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return added
+
+    async def flush(self):
+        pending = self._take_pending()
+        try:
+            self.user_total += await asyncio.to_thread(self._write, *pending)
+        except sqlite3.Error:
+            self._restore_pending(*pending)
+            raise
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(STATS_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"Stats flush failed: {e}")
+
+    def query(self, sql: str, params: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def reachable_users(self, after: int, limit: int) -> list[int]:
+        # Keyset pagination, so a broadcast never holds the whole user list in memory
+        rows = self.query(
+            "SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL ORDER BY user_id LIMIT ?", (after, limit)
+        )
+        return [user_id for (user_id,) in rows]
+
+    def mark_blocked(self, user_ids: list[int]):
+        with self._lock:
+            self._db.executemany(
+                "UPDATE users SET blocked_at = ? WHERE user_id = ?", ((time.time(), user_id) for user_id in user_ids)
+            )
+
+    def close(self):
+        self.user_total += self._write(*self._take_pending())
+        with self._lock:
+            self._db.close()
+
+stats: StatsStore | None = None
+stats_flusher: asyncio.Task | None = None
+
+class RequestLog:
+    """Append-only JSONL log written in batches from a worker thread.
+
+    write() only queues the record; a batch goes to disk once it is full or
+    every flush_interval seconds. Past max_bytes the file is rotated to a
+    timestamped .gz archive and the oldest archives beyond `backups` are removed.
+    """
+
+    def __init__(self, path: str, batch_size: int, flush_interval: float, max_bytes: int, backups: int):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._pending: list[str] = []
+        self._full = asyncio.Event()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def write(self, record: dict):
+        # If the disk falls this far behind, losing log lines beats growing without bound
+        if len(self._pending) >= self.batch_size * 50:
+            self.dropped += 1
+            return
+        self._pending.append(json.dumps(record, ensure_ascii=False))
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+    def _take_pending(self) -> list[str]:
+        lines, self._pending = self._pending, []
+        self._full.clear()
+        return lines
+
+    def _append(self, lines: list[str]):
+        if not lines:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            size = f.tell()
+        if size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        archive = f"{self.path}.{datetime.now():%Y%m%d-%H%M%S-%f}"
+        os.replace(self.path, archive)
+        with open(archive, "rb") as src, gzip.open(f"{archive}.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(archive)
+        directory, base = os.path.split(self.path)
+        archives = sorted(f for f in os.listdir(directory or ".") if f.startswith(f"{base}.") and f.endswith(".gz"))
+        for old in archives[:-self.backups] if self.backups else archives:
+            os.remove(os.path.join(directory, old))
+
+    async def flush(self):
+        await asyncio.to_thread(self._append, self._take_pending())
+
+    async def run_writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except OSError as e:
+                logger.error(f"Request log write failed: {e}")
+
+    def close(self):
+        self._append(self._take_pending())
+
+request_log: RequestLog | None = None
+request_log_writer: asyncio.Task | None = None
+
+class Broadcast:
+    """An announcement going out to every user who hasn't blocked the bot.
+
+    Users are visited in user_id order, a page at a time, with up to
+    BROADCAST_CONCURRENCY sends in flight; the outbound limiter paces them. The
+    cursor and counters are saved after each page, so after a restart the job
+    resumes where it stopped, resending at most one page.
+    """
+
+    def __init__(self, job_id: int, text: str, chat_id: int, message_id: int, cursor: int = -1,
+                 sent: int = 0, failed: int = 0, blocked: int = 0):
+        self.id = job_id
+        self.text = text
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.cursor = cursor
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+        self.total = 0
+
+    COLUMNS = "id, text, chat_id, message_id, cursor, sent, failed, blocked"
+
+    @classmethod
+    async def create(cls, text: str, chat_id: int, message_id: int) -> "Broadcast":
+        rows = await asyncio.to_thread(
+            stats.query,
+            "INSERT INTO broadcasts (text, status, chat_id, message_id, created_at) VALUES (?, 'running', ?, ?, ?) RETURNING id",
+            (text, chat_id, message_id, time.time()),
+        )
+        return cls(rows[0][0], text, chat_id, message_id)
+
+    @classmethod
+    async def unfinished(cls) -> list["Broadcast"]:
+        rows = await asyncio.to_thread(stats.query, f"SELECT {cls.COLUMNS} FROM broadcasts WHERE status = 'running' ORDER BY id")
+        return [cls(*row) for row in rows]
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    def progress_text(self) -> str:
+        return f"📣 Broadcasting... {self.done}/{self.total}\nSent: {self.sent}, Failed: {self.failed}, Blocked: {self.blocked}"
+
+    async def _save(self, status: str = "running"):
+        await asyncio.to_thread(
+            stats.query,
+            # A page finishing after /broadcast stop must not revive the job
+            "UPDATE broadcasts SET status = ?, cursor = ?, sent = ?, failed = ?, blocked = ? WHERE id = ? AND status = 'running'",
+            (status, self.cursor, self.sent, self.failed, self.blocked, self.id),
+        )
+
+    async def _send(self, bot, user_id: int, limiter: asyncio.Semaphore, blocked: list[int]):
+        async with limiter:
+            try:
+                await bot.send_message(
+                    user_id, f"<b>Announcement</b>\n\n{self.text}", parse_mode=ParseMode.HTML,
+                    rate_limit_args={"priority": OutboundLimiter.BULK},
+                )
+                self.sent += 1
+            except Forbidden:
+                # Blocked the bot or deleted their account
+                blocked.append(user_id)
+                self.blocked += 1
+            except TelegramError as e:
+                logger.debug(f"Broadcast to {user_id} failed: {e}")
+                self.failed += 1
+
+    async def _report(self, bot):
+        shown = None
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            text = self.progress_text()
+            if text == shown:
+                continue
+            try:
+                await bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+                shown = text
+            except TelegramError as e:
+                logger.debug(f"Broadcast progress edit failed: {e}")
+
+    async def run(self, bot):
+        rows = await asyncio.to_thread(
+            stats.query, "SELECT COUNT(*) FROM users WHERE user_id > ? AND blocked_at IS NULL", (self.cursor,)
+        )
+        self.total = self.done + rows[0][0]
+        logger.info(f"Broadcast {self.id}: {self.total - self.done} users left")
+        limiter = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        reporter = asyncio.create_task(self._report(bot))
+        try:
+            while page := await asyncio.to_thread(stats.reachable_users, self.cursor, BROADCAST_PAGE_SIZE):
+                blocked: list[int] = []
+                await asyncio.gather(*(self._send(bot, user_id, limiter, blocked) for user_id in page))
+                if blocked:
+                    await asyncio.to_thread(stats.mark_blocked, blocked)
+                self.cursor = page[-1]
+                await self._save()
+        finally:
+            reporter.cancel()
+        await self._save("done")
+        logger.info(f"Broadcast {self.id} done: {self.sent} sent, {self.failed} failed, {self.blocked} blocked")
+        try:
+            await bot.edit_message_text(
+                f"Done! Sent: {self.sent}, Failed: {self.failed}, Blocked: {self.blocked}",
+                chat_id=self.chat_id, message_id=self.message_id,
+            )
+        except TelegramError as e:
+            logger.warning(f"Broadcast status update failed: {e}")
+
+    async def cancel(self):
+        await self._save("cancelled")
+
+current_broadcast: Broadcast | None = None
+broadcast_task: asyncio.Task | None = None
+
+def start_broadcast(job: Broadcast, bot):
+    global current_broadcast, broadcast_task
+    current_broadcast = job
+    broadcast_task = asyncio.create_task(job.run(bot))
+    broadcast_task.add_done_callback(broadcast_finished)
+
+def broadcast_finished(task: asyncio.Task):
+    global current_broadcast
+    current_broadcast = None
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Broadcast stopped: {task.exception()}")
+
+# Telegram file_ids of media we already uploaded, keyed by "<media_type>:<source url>"
+file_id_cache: LRUCache | None = None
+cache_flushers: list[asyncio.Task] = []
+# call_api responses, keyed by (endpoint, normalized url, kwargs)
+api_cache: LRUCache | None = None
+# Short link -> the canonical URL it redirects to
+short_link_cache: LRUCache | None = None
+
+# === METRICS ===
+COMMANDS_TOTAL = Counter("bot_commands_total", "Handled commands", ["command", "outcome"])
+API_LATENCY = Histogram(
+    "bot_api_request_seconds", "Upstream call_api latency (cache misses only)", ["endpoint", "outcome"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60),
+)
+API_RETRIES_TOTAL = Counter("bot_api_retries_total", "call_api attempts that were retried", ["endpoint", "reason"])
+API_HEDGES_TOTAL = Counter("bot_api_hedged_total", "call_api hedge requests by which request answered first", ["endpoint", "winner"])
+TRANSFER_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+DOWNLOAD_SECONDS = Histogram("bot_download_seconds", "Media download time", ["platform", "media_type", "outcome"], buckets=TRANSFER_BUCKETS)
+UPLOAD_SECONDS = Histogram("bot_upload_seconds", "Telegram upload time", ["platform", "media_type", "outcome"], buckets=TRANSFER_BUCKETS)
+TRANSFER_BYTES = Counter("bot_transfer_bytes_total", "Media bytes moved", ["direction"])
+RETRY_AFTER_TOTAL = Counter("bot_telegram_retry_after_total", "Bot API calls rejected by flood control", ["endpoint"])
+
+class BotCollector:
+    # Exposes state that already lives in other objects instead of mirroring it into metrics
+
+    def __init__(self, app: Application):
+        self.app = app
+
+    def collect(self):
+        hits = CounterMetricFamily("bot_cache_hits", "Cache hits", labels=["cache"])
+        misses = CounterMetricFamily("bot_cache_misses", "Cache misses", labels=["cache"])
+        entries = GaugeMetricFamily("bot_cache_entries", "Cache entries", labels=["cache"])
+        for cache in (file_id_cache, api_cache, short_link_cache):
+            if cache is not None:
+                hits.add_metric([cache.name], cache.hits)
+                misses.add_metric([cache.name], cache.misses)
+                entries.add_metric([cache.name], len(cache))
+        yield from (hits, misses, entries)
+        scheduler = self.app.update_processor
+        yield GaugeMetricFamily("bot_updates_running", "Updates being processed", value=scheduler.running)
+        yield GaugeMetricFamily("bot_updates_queued", "Updates waiting for a slot", value=scheduler.queue_depth)
+        yield GaugeMetricFamily("bot_transfer_reserved_bytes", "Bytes reserved by in-flight transfers", value=transfer_budget.reserved)
+        yield GaugeMetricFamily("bot_transfer_budget_bytes", "Transfer budget capacity", value=transfer_budget.capacity)
+        yield GaugeMetricFamily("bot_transfers_waiting", "Transfers waiting for budget", value=transfer_budget.waiting)
+        if request_log is not None:
+            yield CounterMetricFamily("bot_request_log_dropped", "Request log lines dropped under backpressure", value=request_log.dropped)
+        limiter = self.app.bot.rate_limiter
+        if isinstance(limiter, OutboundLimiter):
+            yield GaugeMetricFamily("bot_outbound_queued", "Bot API calls waiting for the global rate limit", value=limiter.queued)
+        if stats is not None:
+            yield GaugeMetricFamily("bot_known_users", "Users that have used the bot", value=stats.user_total)
+        yield CounterMetricFamily("bot_coalesced_calls", "Calls served by an identical in-flight call", value=api_flight.coalesced + media_flight.coalesced)
+
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower() or "https", parts.netloc.lower(), parts.path, parts.query, ""))
+
+def build_http_client(max_connections: int, timeout: float | httpx.Timeout) -> httpx.AsyncClient:
+    # HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 keep-alive without it
+    http2 = HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout, follow_redirects=True)
+
+async def post_init(app: Application):
+    global api_client, media_client, file_id_cache, api_cache, short_link_cache, cache_flushers, stats, stats_flusher, request_log, request_log_writer
+    stats = StatsStore(DB_PATH)
+    stats_flusher = asyncio.create_task(stats.run_flusher())
+    if REQUEST_LOG_PATH:
+        request_log = RequestLog(
+            REQUEST_LOG_PATH, REQUEST_LOG_BATCH_SIZE, REQUEST_LOG_FLUSH_INTERVAL, REQUEST_LOG_MAX_BYTES, REQUEST_LOG_BACKUPS
+        )
+        request_log_writer = asyncio.create_task(request_log.run_writer())
+    api_client = build_http_client(HTTP_MAX_CONNECTIONS_PER_HOST, timeout=httpx.Timeout(API_ATTEMPT_TIMEOUT, connect=API_CONNECT_TIMEOUT))
+    media_client = build_http_client(MEDIA_MAX_CONNECTIONS, timeout=60)
+    file_id_cache = LRUCache("file_ids", FILE_ID_CACHE_SIZE, FILE_ID_CACHE_TTL, DB_PATH)
+    api_cache = LRUCache("api", API_CACHE_SIZE, API_CACHE_TTL, DB_PATH if API_CACHE_PERSIST else None)
+    short_link_cache = LRUCache("short_links", SHORT_LINK_CACHE_SIZE, SHORT_LINK_CACHE_TTL, DB_PATH)
+    cache_flushers = [
+        asyncio.create_task(cache.run_flusher()) for cache in (file_id_cache, api_cache, short_link_cache) if cache.persistent
+    ]
+    logger.info(f"API client ready (max {HTTP_MAX_CONNECTIONS_PER_HOST} connections per host)")
+    if app is not None:
+        # Pick up a broadcast that was interrupted by a restart
+        for job in await Broadcast.unfinished():
+            logger.info(f"Resuming broadcast {job.id} after user {job.cursor}")
+            start_broadcast(job, app.bot)
+            break
+
+async def post_shutdown(app: Application):
+    global api_client, media_client
+    if broadcast_task is not None and not broadcast_task.done():
+        # Its cursor is saved after every page; the job resumes on the next start
+        broadcast_task.cancel()
+        try:
+            await broadcast_task
+        except asyncio.CancelledError:
+            pass
+    for client in (api_client, media_client):
+        if client is not None:
+            await client.aclose()
+    api_client = media_client = None
+    for task in cache_flushers:
+        task.cancel()
+    for cache in (file_id_cache, api_cache, short_link_cache):
+        if cache is not None:
+            cache.close()
+    if stats is not None:
+        stats_flusher.cancel()
+        stats.close()
+    if request_log is not None:
+        request_log_writer.cancel()
+        request_log.close()
+
 async def call_api(endpoint: str, url: str, **kwargs) -> dict:
+    cache_key = json.dumps([endpoint, normalize_url(url), sorted(kwargs.items())])
+    with trace_span("call_api", endpoint=endpoint) as span:
+        cached = api_cache.get(cache_key)
+        span.attrs["cached"] = cached is not None
+        if cached is not None:
+            return cached
+        return await api_flight.do(cache_key, lambda: fetch_api(endpoint, url, kwargs, cache_key))
+
+async def fetch_api(endpoint: str, url: str, kwargs: dict, cache_key: str) -> dict:
+    started = time.perf_counter()
     try:
-        full_url = f"{API_BASE_URL}/{endpoint}"
         params = {'url': url}
         params.update(kwargs)
-        response = await asyncio.to_thread(requests.get, full_url, params=params, timeout=30)
-        response.raise_for_status()
-        return response.json()
+        data = await asyncio.wait_for(request_with_retries(endpoint, params), API_DEADLINE)
     except Exception as e:
-        logger.error(f"API Error ({endpoint}): {e}")
-        return {"success": False, "error": str(e)}
+        # Transport errors are not cached; the next lookup should really retry
+        API_LATENCY.labels(endpoint, "error").observe(time.perf_counter() - started)
+        error = "Upstream API timed out" if isinstance(e, asyncio.TimeoutError) else str(e) or type(e).__name__
+        logger.error(f"API Error ({endpoint}): {error}")
+        return {"success": False, "error": error}
+    API_LATENCY.labels(endpoint, "ok").observe(time.perf_counter() - started)
+    if isinstance(data, dict):
+        # "success: false" is usually a private/deleted post: cache it briefly only
+        ttl = API_CACHE_TTLS.get(endpoint, API_CACHE_TTL) if data.get("success") else API_CACHE_NEGATIVE_TTL
+        if ttl > 0:
+            api_cache.set(cache_key, data, ttl)
+    return data
+
+# Latencies of recent successful attempts per endpoint, for the hedging delay
+api_latencies: dict[str, deque[float]] = {}
+hedges_in_flight = 0
 
-async def loading_animation(msg):
-    spinner = ['⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧', '⠇', '⠏']
-    i = 0
+def hedge_delay(endpoint: str) -> float | None:
+    samples = api_latencies.get(endpoint)
+    if not API_HEDGE or samples is None or len(samples) < API_HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    return max(ordered[int(len(ordered) * 0.95) - 1], API_HEDGE_MIN_DELAY)
+
+async def api_attempt(endpoint: str, params: dict, hedge: bool = False) -> Any:
+    with trace_span("api_attempt", hedge=hedge) as span:
+        started = time.perf_counter()
+        response = await api_client.get(f"{API_BASE_URL}/{endpoint}", params=params)
+        span.attrs["status"] = response.status_code
+        response.raise_for_status()
+        data = response.json()
+    api_latencies.setdefault(endpoint, deque(maxlen=200)).append(time.perf_counter() - started)
+    return data
+
+def hedge_done(task: asyncio.Task):
+    global hedges_in_flight
+    hedges_in_flight -= 1
+
+async def hedged_request(endpoint: str, params: dict) -> Any:
+    """One attempt, plus a duplicate if the first outlives the endpoint's p95; the first success wins."""
+    global hedges_in_flight
+    delay = hedge_delay(endpoint)
+    if delay is None:
+        return await api_attempt(endpoint, params)
+    tasks = [asyncio.create_task(api_attempt(endpoint, params))]
     try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done and hedges_in_flight < API_HEDGE_MAX_IN_FLIGHT:
+            hedges_in_flight += 1
+            hedge = asyncio.create_task(api_attempt(endpoint, params, hedge=True))
+            hedge.add_done_callback(hedge_done)
+            tasks.append(hedge)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if len(tasks) > 1:
+                        API_HEDGES_TOTAL.labels(endpoint, "hedge" if task is tasks[1] else "primary").inc()
+                    return task.result()
+        # Both failed; the primary's error is the one worth retrying on
+        raise tasks[0].exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def retry_reason(e: Exception) -> str | None:
+    if isinstance(e, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(e, httpx.TransportError):
+        return "transport"
+    if isinstance(e, httpx.HTTPStatusError) and (e.response.status_code >= 500 or e.response.status_code == 429):
+        return str(e.response.status_code)
+    # Other 4xx and malformed JSON won't get better by asking again
+    return None
+
+def retry_delay(attempt: int, e: Exception) -> float:
+    if isinstance(e, httpx.HTTPStatusError):
+        retry_after = e.response.headers.get("retry-after", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), API_RETRY_MAX_DELAY)
+    # Full jitter, so clients that failed together don't retry together
+    return random.uniform(0, min(API_RETRY_MAX_DELAY, API_RETRY_BACKOFF * 2 ** attempt))
+
+async def request_with_retries(endpoint: str, params: dict) -> Any:
+    for attempt in range(API_RETRIES + 1):
+        try:
+            return await hedged_request(endpoint, params)
+        except Exception as e:
+            reason = retry_reason(e)
+            if reason is None or attempt == API_RETRIES:
+                raise
+            delay = retry_delay(attempt, e)
+            API_RETRIES_TOTAL.labels(endpoint, reason).inc()
+            logger.info(f"API attempt {attempt + 1} ({endpoint}) failed with {reason}, retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, cost: float = 1) -> bool:
+        self._refill(time.monotonic())
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def wait_time(self, cost: float = 1) -> float:
+        # Seconds until cost tokens are available; 0 if they are now
+        self._refill(time.monotonic())
+        return max(cost - self.tokens, 0) / self.rate
+
+# Shared by every status message so concurrent requests can't add up to a flood
+progress_edit_budget = TokenBucket(PROGRESS_EDITS_PER_SECOND, PROGRESS_EDITS_PER_SECOND)
+progress_last_edit: dict[int, float] = {}
+
+class ProgressReporter:
+    """Status message driven by real download and upload byte counts instead of a timer.
+
+    The message is only edited when the rendered text changes, at most once per
+    PROGRESS_MIN_INTERVAL per chat and within the global edit budget.
+    """
+
+    def __init__(self, msg: Message, stage: str = "Processing"):
+        self.msg = msg
+        self.stage = stage
+        self.done_bytes = 0
+        self.total_bytes = 0
+        self.sizes_known = True
+        self._shown = msg.text
+        self._task = asyncio.create_task(self._run())
+
+    def set_stage(self, stage: str):
+        self.stage = stage
+
+    def start_upload(self, size: int):
+        # From here on the percentage is the upload's, not the finished download's
+        self.stage = "Uploading"
+        self.done_bytes, self.total_bytes, self.sizes_known = 0, size, True
+
+    def add_total(self, size: int | None):
+        if size is None:
+            self.sizes_known = False
+        else:
+            self.total_bytes += size
+
+    def advance(self, size: int):
+        self.done_bytes += size
+
+    def render(self) -> str:
+        if self.total_bytes and self.sizes_known:
+            # 5% steps: at most 20 distinct texts per request
+            percent = min(self.done_bytes * 20 // self.total_bytes * 5, 100)
+            return f"⏳ {self.stage}... {percent}%"
+        if self.done_bytes:
+            return f"⏳ {self.stage}... {self.done_bytes / (1024 * 1024):.1f} MB"
+        return f"⏳ {self.stage}..."
+
+    async def _run(self):
+        chat_id = self.msg.chat_id
         while True:
-            await msg.edit_text(f"{spinner[i % 10]} Processing...")
-            i += 1
-            await asyncio.sleep(0.3)
-    except:
+            await asyncio.sleep(PROGRESS_MIN_INTERVAL)
+            text = self.render()
+            now = time.monotonic()
+            if text == self._shown or now - progress_last_edit.get(chat_id, 0) < PROGRESS_MIN_INTERVAL:
+                continue
+            if not progress_edit_budget.try_acquire():
+                continue
+            progress_last_edit[chat_id] = now
+            try:
+                with trace_span("status_edit"):
+                    await self.msg.edit_text(text)
+                self._shown = text
+            except TelegramError as e:
+                logger.debug(f"Progress edit failed: {e}")
+
+    def stop(self):
+        self._task.cancel()
+        if len(progress_last_edit) > 10000:
+            cutoff = time.monotonic() - PROGRESS_MIN_INTERVAL
+            for chat_id in [c for c, t in progress_last_edit.items() if t < cutoff]:
+                del progress_last_edit[chat_id]
+
+    async def done(self, text: str | None = None, **kwargs):
+        # Stop first so a late progress edit can't overwrite the final text
+        self.stop()
+        with trace_span("status_edit", final=True):
+            if text is None:
+                await self.msg.delete()
+            else:
+                await self.msg.edit_text(text, **kwargs)
+
+class TokenBuckets:
+    """One token bucket per key, kept in an LRU ordered by last use.
+
+    A bucket idle long enough to be full again is identical to a fresh one, so
+    those are evicted from the cold end; past max_keys the coldest goes regardless.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+
+    def get(self, key: int) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets.move_to_end(key)
+            return bucket
+        self._evict(time.monotonic())
+        bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _evict(self, now: float):
+        refill_time = self.burst / self.rate
+        while self._buckets:
+            oldest = next(iter(self._buckets.values()))
+            if len(self._buckets) < self.max_keys and now - oldest.updated < refill_time:
+                return
+            self._buckets.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+class RateLimiter:
+    """Per-user token buckets behind one global bucket; a rate of 0 turns either off."""
+
+    def __init__(self, rate: float, burst: float, global_rate: float, global_burst: float, max_users: int):
+        self.users = TokenBuckets(rate, burst, max_users) if rate else None
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate else None
+
+    def acquire(self, user_id: int, cost: float = 1) -> float:
+        """Take cost tokens from both buckets; if either is short, take nothing and return the wait."""
+        buckets = [b for b in (self.users.get(user_id) if self.users is not None else None, self.global_bucket) if b is not None]
+        # A cost above the burst could never be paid
+        cost = min([cost] + [b.capacity for b in buckets])
+        wait = max([b.wait_time(cost) for b in buckets], default=0)
+        if wait:
+            return wait
+        for bucket in buckets:
+            bucket.tokens -= cost
+        return 0
+
+rate_limiter = RateLimiter(1 / COMMAND_COOLDOWN if COMMAND_COOLDOWN else 0, RATE_LIMIT_BURST, GLOBAL_RATE_LIMIT, GLOBAL_RATE_BURST, RATE_LIMIT_MAX_USERS)
+
+class OutboundLimiter(BaseRateLimiter):
+    """Throttles every Bot API call to Telegram's global and per-chat limits.
+
+    Calls queue for their chat's bucket first, then for the global bucket, each
+    served in priority order: replies and media before status-message edits, and
+    both before broadcasts. A 429 pauses the chat (or everything, for calls without a
+    chat) for its retry_after and the call is queued again.
+    """
+
+    HIGH, LOW, BULK = 0, 1, 2
+    # Status message upkeep; nobody waits on these the way they wait on their media
+    LOW_PRIORITY_ENDPOINTS = {"editMessageText", "deleteMessage", "sendChatAction"}
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, group_rate_per_minute: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_chats = TokenBuckets(chat_rate, chat_burst, RATE_LIMIT_MAX_USERS)
+        self.group_chats = TokenBuckets(group_rate_per_minute / 60, chat_burst, RATE_LIMIT_MAX_USERS)
+        self.max_retries = max_retries
+        self._paused_until = 0.0
+        self._chat_paused_until: dict[int, float] = {}
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._chat_waiters: dict[int, list[tuple[int, int, asyncio.Future]]] = {}
+        self._chat_pumps: dict[int, asyncio.Task] = {}
+        self._seq = 0
+        self._pump: asyncio.Task | None = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters) + sum(len(waiters) for waiters in self._chat_waiters.values())
+
+    async def initialize(self):
         pass
 
-def check_cooldown(context: CallbackContext, user_id: int) -> tuple[bool, float]:
-    if is_admin(user_id):
-        return False, 0
-    now = time.time()
-    last = context.user_data.get('last_cmd', 0)
-    if now - last < COMMAND_COOLDOWN:
-        return True, round(COMMAND_COOLDOWN - (now - last), 1)
-    context.user_data['last_cmd'] = now
-    return False, 0
+    async def shutdown(self):
+        for pump in (self._pump, *self._chat_pumps.values()):
+            if pump is not None:
+                pump.cancel()
+        for waiters in (self._waiters, *self._chat_waiters.values()):
+            for _, _, waiter in waiters:
+                waiter.cancel()
+            waiters.clear()
+
+    @staticmethod
+    def _chat_key(chat_id) -> int | None:
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            # None, or an @channel username
+            return None
+
+    def _enqueue(self, waiters: list, priority: int) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(waiters, (priority, self._seq, waiter))
+        return waiter
+
+    @staticmethod
+    async def _serve(waiters: list, bucket: TokenBucket, paused_until):
+        # Hands out the bucket's tokens strictly in (priority, arrival) order
+        while waiters:
+            if waiters[0][2].done():
+                heapq.heappop(waiters)
+                continue
+            wait = max(bucket.wait_time(), paused_until() - time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            bucket.tokens -= 1
+            heapq.heappop(waiters)[2].set_result(None)
+
+    def _chat_pause_end(self, chat_id: int) -> float:
+        until = self._chat_paused_until.get(chat_id, 0)
+        if until and until <= time.monotonic():
+            del self._chat_paused_until[chat_id]
+        return until
+
+    async def _wait_chat(self, chat_id: int | None, priority: int):
+        if chat_id is None:
+            return
+        bucket = self.private_chats.get(chat_id) if chat_id > 0 else self.group_chats.get(chat_id)
+        waiters = self._chat_waiters.get(chat_id)
+        if waiters is None:
+            if self._chat_pause_end(chat_id) <= time.monotonic() and bucket.try_acquire():
+                return
+            waiters = self._chat_waiters[chat_id] = []
+        waiter = self._enqueue(waiters, priority)
+        if chat_id not in self._chat_pumps:
+            self._chat_pumps[chat_id] = asyncio.create_task(self._run_chat_pump(chat_id, bucket, waiters))
+        await waiter
+
+    async def _run_chat_pump(self, chat_id: int, bucket: TokenBucket, waiters: list):
+        try:
+            await self._serve(waiters, bucket, lambda: self._chat_pause_end(chat_id))
+        finally:
+            # Nothing awaits between the queue running empty and this, so no waiter is stranded
+            del self._chat_waiters[chat_id], self._chat_pumps[chat_id]
+
+    async def _wait_global(self, priority: int):
+        if not self._waiters and time.monotonic() >= self._paused_until and self.global_bucket.try_acquire():
+            return
+        waiter = self._enqueue(self._waiters, priority)
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._serve(self._waiters, self.global_bucket, lambda: self._paused_until))
+        await waiter
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get("priority")
+        if priority is None:
+            priority = self.LOW if endpoint in self.LOW_PRIORITY_ENDPOINTS else self.HIGH
+        chat_id = self._chat_key(data.get("chat_id"))
+        for attempt in range(self.max_retries + 1):
+            await self._wait_chat(chat_id, priority)
+            await self._wait_global(priority)
+            try:
+                async with transfer_budget.hold(upload_size.get()):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                RETRY_AFTER_TOTAL.labels(endpoint).inc()
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                until = time.monotonic() + delay
+                if chat_id is not None:
+                    self._chat_paused_until[chat_id] = until
+                else:
+                    self._paused_until = until
+                logger.warning(f"Flood control on {endpoint} (chat {chat_id}), retrying in {delay}s")
+
+def check_rate_limit(user_id: int, cmd: str) -> tuple[bool, float]:
+    with trace_span("rate_limit"):
+        if is_admin(user_id):
+            return False, 0
+        wait = rate_limiter.acquire(user_id, COMMAND_COSTS.get(cmd, 1))
+        if not wait:
+            return False, 0
+        COMMANDS_TOTAL.labels(cmd, "rate_limited").inc()
+        root = request_span.get()
+        if root is not None:
+            root.attrs["outcome"] = "rate_limited"
+        return True, max(round(wait, 1), 0.1)
 
 def track_command(user_id: int, cmd: str, success: bool):
-    stats["total_requests"] += 1
-    stats["users"].add(user_id)
-    if success:
-        stats["successful_requests"] += 1
-    else:
-        stats["failed_requests"] += 1
-    stats["commands_used"][cmd] = stats["commands_used"].get(cmd, 0) + 1
+    stats.track(user_id, cmd, success)
+    root = request_span.get()
+    if root is not None:
+        root.attrs["outcome"] = "success" if success else "failure"
+    COMMANDS_TOTAL.labels(cmd, "success" if success else "failure").inc()
+
+def current_platform() -> str:
+    # The root span is named after the command, so transfers can be told apart by platform
+    root = request_span.get()
+    return root.name if root is not None else "none"
 
-async def send_media_from_url(update: Update, file_url: str, media_type: str, caption: str = "", filename_prefix: str = "download"):
+def content_length(response: httpx.Response) -> int | None:
     try:
-        r = await asyncio.to_thread(requests.get, file_url, timeout=60, stream=True)
-        r.raise_for_status()
-        data = r.content
-
-        ext = ".jpg" if media_type == "photo" else ".mp4" if media_type == "video" else ".mp3"
-        filename = f"{filename_prefix}{ext}"
-
-        if media_type == "video" and len(data) > 50 * 1024 * 1024:
-            raise ValueError("Video >50MB")
-        if media_type == "photo" and len(data) > 10 * 1024 * 1024:
-            raise ValueError("Photo >10MB")
-
-        if media_type == "video":
-            await update.message.reply_video(video=data, caption=caption, filename=filename, parse_mode=ParseMode.HTML)
-        elif media_type == "audio":
-            await update.message.reply_audio(audio=data, caption=caption, filename=filename, parse_mode=ParseMode.HTML)
-        elif media_type == "photo":
-            await update.message.reply_photo(photo=data, caption=caption, filename=filename, parse_mode=ParseMode.HTML)
+        length = int(response.headers["content-length"])
+    except (KeyError, ValueError):
+        return None
+    return length if length >= 0 else None
+
+def unexpected_content_type(response: httpx.Response, media_type: str) -> str | None:
+    # A web page (a login wall, a profile) where the file should be; documents may be text
+    content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type in ("text/html", "application/xhtml+xml"):
+        return content_type
+    if media_type != "document" and (content_type.startswith("text/") or content_type in ("application/json", "application/xml")):
+        return content_type
+    return None
+
+def too_large(media_type: str) -> MediaTooLarge:
+    return MediaTooLarge(f"{media_type.capitalize()} >{MEDIA_LIMITS[media_type] // (1024 * 1024)}MB")
+
+class ByteBudget:
+    """FIFO admission control over the bytes moved by in-flight media transfers.
+
+    A reservation is only held while bytes are actually moving (one download or one
+    upload), never while waiting on something else, so transfers can't deadlock
+    each other however the budget is split.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.reserved = 0
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def utilization(self) -> float:
+        return self.reserved / self.capacity
+
+    async def acquire(self, size: int) -> int:
+        # A transfer larger than the whole budget may still run, just on its own
+        size = min(size, self.capacity)
+        if not size:
+            # Calls that move no media (every Bot API call but uploads) never queue here
+            return 0
+        if not self._waiters and self.reserved + size <= self.capacity:
+            self.reserved += size
+            return size
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (size, waiter)
+        self._waiters.append(entry)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(size)
+            else:
+                # _wake may already have dropped the cancelled entry
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                self._wake()
+            raise
+        return size
+
+    def release(self, size: int):
+        self.reserved -= size
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.reserved + self._waiters[0][0] <= self.capacity:
+            size, waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.reserved += size
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def hold(self, size: int):
+        size = await self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+transfer_budget = ByteBudget(TRANSFER_BUDGET_BYTES)
+# Bytes the Bot API call made from this context uploads. OutboundLimiter reserves them
+# only once the call is admitted, so a chat waiting out flood control holds no budget.
+upload_size: ContextVar[int] = ContextVar("upload_size", default=0)
+
+def spool_size(spool) -> int:
+    position = spool.tell()
+    spool.seek(0, os.SEEK_END)
+    size = spool.tell()
+    spool.seek(position)
+    return size
+
+async def download_media(file_url: str, media_type: str, progress: ProgressReporter | None = None) -> tempfile.SpooledTemporaryFile:
+    # Spool chunks to memory/disk and give up as soon as the Telegram limit is crossed,
+    # so an oversized file never costs more than limit + one chunk of RAM or bandwidth.
+    limit = MEDIA_LIMITS[media_type]
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT)
+    started = time.perf_counter()
+    span = start_span("download", media_type=media_type)
+    size = 0
+    try:
+        async with media_client.stream("GET", file_url) as r:
+            r.raise_for_status()
+            content_type = unexpected_content_type(r, media_type)
+            if content_type:
+                raise NotMedia(f"Expected {media_type}, got {content_type}")
+            # Pre-flight: reject on the declared size before reading any of the body.
+            # Missing or lying headers are still caught by the byte count below.
+            declared = content_length(r)
+            if declared is not None and declared > limit:
+                raise too_large(media_type)
+            if progress is not None:
+                progress.add_total(declared)
+            # Unknown sizes reserve the worst case for this media type
+            async with transfer_budget.hold(limit if declared is None else declared):
+                async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > limit:
+                        raise too_large(media_type)
+                    spool.write(chunk)
+                    TRANSFER_BYTES.labels("download").inc(len(chunk))
+                    if progress is not None:
+                        progress.advance(len(chunk))
+        DOWNLOAD_SECONDS.labels(current_platform(), media_type, "ok").observe(time.perf_counter() - started)
+        span.finish(bytes=size, outcome="ok")
+        spool.seek(0)
+        return spool
+    except BaseException as e:
+        outcome = "too_large" if isinstance(e, MediaTooLarge) else "not_media" if isinstance(e, NotMedia) else "error"
+        DOWNLOAD_SECONDS.labels(current_platform(), media_type, outcome).observe(time.perf_counter() - started)
+        span.finish(bytes=size, outcome=outcome)
+        spool.close()
+        raise
+
+@asynccontextmanager
+async def observe_upload(media_type: str, size: int):
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        UPLOAD_SECONDS.labels(current_platform(), media_type, "error").observe(time.perf_counter() - started)
+        raise
+    UPLOAD_SECONDS.labels(current_platform(), media_type, "ok").observe(time.perf_counter() - started)
+    TRANSFER_BYTES.labels("upload").inc(size)
+
+class UploadReader:
+    """The view of a spool the HTTP backend uploads from: read, seek and tell, nothing else.
+
+    Without fileno() httpx sizes the body by seeking, so a spool still in memory is not
+    rolled over to disk just to be measured. Reads move the ProgressReporter, if any.
+    """
+
+    def __init__(self, file, progress: ProgressReporter | None = None):
+        self._file = file
+        self._progress = progress
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._file.read(size)
+        if self._progress is not None:
+            # The position rather than a running sum, so a retried upload starts over from 0%
+            self._progress.done_bytes = self._file.tell()
+        return chunk
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+def upload_file(spool, filename: str, attach: bool = False, progress: ProgressReporter | None = None) -> InputFile:
+    # Hand the open spool to the HTTP backend as-is: no name guessing (in-memory spools have
+    # none) and no read() into a second in-memory copy of the file
+    return InputFile(UploadReader(spool, progress), filename=filename, attach=attach, read_file_handle=False)
+
+async def reply_media(update: Update, media_type: str, media, caption: str = "", filename: str | None = None, progress: ProgressReporter | None = None) -> Message:
+    with trace_span("send", media_type=media_type, by_file_id=isinstance(media, str)):
+        if hasattr(media, "read"):
+            size = spool_size(media)
+            if progress is not None:
+                progress.start_upload(size)
+            token = upload_size.set(size)
+            try:
+                async with observe_upload(media_type, size):
+                    return await _reply_media(update, media_type, upload_file(media, filename, progress=progress), caption)
+            finally:
+                upload_size.reset(token)
+        return await _reply_media(update, media_type, media, caption, filename)
+
+async def _reply_media(update: Update, media_type: str, media, caption: str = "", filename: str | None = None) -> Message:
+    if media_type == "video":
+        return await update.message.reply_video(video=media, caption=caption, filename=filename, parse_mode=ParseMode.HTML)
+    if media_type == "audio":
+        return await update.message.reply_audio(audio=media, caption=caption, filename=filename, parse_mode=ParseMode.HTML)
+    if media_type == "document":
+        return await update.message.reply_document(document=media, caption=caption, filename=filename, parse_mode=ParseMode.HTML)
+    return await update.message.reply_photo(photo=media, caption=caption, filename=filename, parse_mode=ParseMode.HTML)
+
+def extract_file_id(message: Message) -> str | None:
+    attachment = message.effective_attachment
+    if isinstance(attachment, (list, tuple)):
+        # Photos come back as a list of sizes; the last one is the original
+        attachment = attachment[-1] if attachment else None
+    return getattr(attachment, "file_id", None)
+
+def media_filename(prefix: str, media_type: str) -> str:
+    # Documents are named after the file they came from, extension included
+    ext = {"photo": ".jpg", "video": ".mp4", "audio": ".mp3"}.get(media_type, "")
+    return f"{prefix}{ext}"
+
+def media_cache_key(media_type: str, source_url: str, item: int = 0) -> str:
+    # item tells apart the media of one multi-item post
+    return f"{media_type}:{normalize_url(source_url)}#{item}"
+
+def prefetch_media(file_url: str, media_type: str, source_url: str, item: int, limiter: asyncio.Semaphore, progress: ProgressReporter | None = None) -> asyncio.Task | None:
+    # Start downloading ahead of the send; nothing to fetch if Telegram already has it
+    if media_cache_key(media_type, source_url, item) in file_id_cache:
+        return None
+
+    async def run():
+        async with limiter:
+            return await download_media(file_url, media_type, progress)
+    return asyncio.create_task(run())
+
+def discard_prefetch(task: asyncio.Task | None):
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+async def send_media_from_url(update: Update, file_url: str, media_type: str, caption: str = "", filename_prefix: str = "download", source_url: str | None = None, item: int = 0, progress: ProgressReporter | None = None):
+    # source_url is the post the media came from; CDN links are signed and change per lookup
+    cache_key = media_cache_key(media_type, source_url or file_url, item)
+    file_id = file_id_cache.get(cache_key)
+    if file_id:
+        try:
+            await reply_media(update, media_type, file_id, caption)
+            return True
+        except TelegramError as e:
+            logger.info(f"Cached file_id rejected, re-downloading: {e}")
+            file_id_cache.delete(cache_key)
+
+    filename = media_filename(filename_prefix, media_type)
+    leader = False
+
+    async def upload() -> str | None:
+        nonlocal leader
+        leader = True
+        with await download_media(file_url, media_type, progress) as data:
+            try:
+                message = await reply_media(update, media_type, data, caption, filename, progress)
+            except Exception as e:
+                raise _ReplyFailed(e) from e
+        file_id = extract_file_id(message)
+        if file_id:
+            file_id_cache.set(cache_key, file_id)
+        return file_id
+
+    try:
+        while True:
+            try:
+                file_id = await media_flight.do(cache_key, upload)
+                break
+            except _ReplyFailed as e:
+                if leader:
+                    raise e.__cause__
+                # Only the leader's chat failed (blocked bot, flood wait), not the media:
+                # try again, with one of the remaining callers doing the upload. Download
+                # errors are shared like the result, so a dead link fails everyone at once.
+                logger.info(f"Shared upload failed in another chat, retrying it: {e}")
+        if not leader:
+            # Another request just uploaded the same media: reuse its file_id, no second download
+            if file_id:
+                await reply_media(update, media_type, file_id, caption)
+            else:
+                await upload()
         return True
+    except (MediaTooLarge, NotMedia) as e:
+        logger.info(f"Skipping download, falling back to link: {e}")
+        return False
     except Exception as e:
         logger.warning(f"Send failed: {e}")
         return False
 
+async def send_album_item(update: Update, item: tuple, source_url: str, caption: str, filename_prefix: str) -> bool:
+    i, url, media_type, media = item
+    if isinstance(media, str):
+        return await send_media_from_url(update, url, media_type, f"{caption} {i}", f"{filename_prefix}_{i}", source_url, i)
+    media.seek(0)
+    try:
+        message = await reply_media(update, media_type, media, f"{caption} {i}", media_filename(f"{filename_prefix}_{i}", media_type))
+    except TelegramError as e:
+        logger.warning(f"Send failed: {e}")
+        return False
+    file_id = extract_file_id(message)
+    if file_id:
+        file_id_cache.set(media_cache_key(media_type, source_url, i), file_id)
+    return True
+
+async def send_album(update: Update, batch: list, source_url: str, caption: str, filename_prefix: str) -> list[str]:
+    # batch holds (item, url, media_type, media) where media is a cached file_id or a spool;
+    # returns the urls that could not be delivered
+    if len(batch) == 1:
+        sent = await send_album_item(update, batch[0], source_url, caption, filename_prefix)
+        return [] if sent else [batch[0][1]]
+    media_group = []
+    for i, url, media_type, media in batch:
+        input_media = InputMediaVideo if media_type == "video" else InputMediaPhoto
+        if not isinstance(media, str):
+            media.seek(0)
+            media = upload_file(media, media_filename(f"{filename_prefix}_{i}", media_type), attach=True)
+        media_group.append(input_media(media, caption=f"{caption} {i}", parse_mode=ParseMode.HTML))
+    upload_bytes = sum(spool_size(media) for _, _, _, media in batch if not isinstance(media, str))
+    try:
+        with trace_span("send", media_type="album", items=len(media_group)):
+            token = upload_size.set(upload_bytes)
+            try:
+                async with observe_upload("album", upload_bytes):
+                    messages = await update.message.reply_media_group(media_group)
+            finally:
+                upload_size.reset(token)
+    except TelegramError as e:
+        # Usually a stale cached file_id; retry item by item, which re-downloads those
+        logger.warning(f"Media group failed, sending items one by one: {e}")
+        failed = []
+        for item in batch:
+            if not await send_album_item(update, item, source_url, caption, filename_prefix):
+                failed.append(item[1])
+        return failed
+    for (i, url, media_type, media), message in zip(batch, messages):
+        file_id = extract_file_id(message)
+        if file_id and not isinstance(media, str):
+            file_id_cache.set(media_cache_key(media_type, source_url, i), file_id)
+    return []
+
+async def send_media_group_from_urls(update: Update, items: list[tuple[str, str]], source_url: str, caption: str, filename_prefix: str, progress: ProgressReporter | None = None) -> tuple[int, list[str]]:
+    # items are (url, media_type) pairs in post order. Downloads run concurrently, then the
+    # items go out as albums of up to MEDIA_GROUP_SIZE; oversized ones are returned as links.
+    limiter = asyncio.Semaphore(CAROUSEL_CONCURRENCY)
+    downloads = [prefetch_media(url, media_type, source_url, i, limiter, progress) for i, (url, media_type) in enumerate(items, 1)]
+    sent = 0
+    fallback = []
+    batch = []
+    batch_bytes = 0
+
+    async def flush():
+        nonlocal sent, batch, batch_bytes
+        failed = await send_album(update, batch, source_url, caption, filename_prefix)
+        sent += len(batch) - len(failed)
+        fallback.extend(failed)
+        for _, _, _, media in batch:
+            if not isinstance(media, str):
+                media.close()
+        batch, batch_bytes = [], 0
+
+    try:
+        for i, ((url, media_type), download) in enumerate(zip(items, downloads), 1):
+            if progress is not None:
+                progress.set_stage(f"Downloading {i}/{len(items)}")
+            media = file_id_cache.get(media_cache_key(media_type, source_url, i))
+            size = 0
+            if not media:
+                try:
+                    media = await (download or download_media(url, media_type, progress))
+                except (MediaTooLarge, NotMedia) as e:
+                    logger.info(f"Skipping download, falling back to link: {e}")
+                    fallback.append(url)
+                    continue
+                except Exception as e:
+                    logger.warning(f"Send failed: {e}")
+                    fallback.append(url)
+                    continue
+                size = spool_size(media)
+            if batch and (len(batch) == MEDIA_GROUP_SIZE or batch_bytes + size > MEDIA_GROUP_MAX_BYTES):
+                await flush()
+            batch.append((i, url, media_type, media))
+            batch_bytes += size
+        if batch:
+            await flush()
+    finally:
+        for download in downloads:
+            discard_prefetch(download)
+        for _, _, _, media in batch:
+            if not isinstance(media, str):
+                media.close()
+    return sent, fallback
+
+# === UPDATE SCHEDULER ===
+class FairScheduler(BaseUpdateProcessor):
+    """Runs updates concurrently with a global and a per-user cap.
+
+    Updates over the caps wait in per-user queues that are served round-robin,
+    so one user pasting twenty links can't starve everybody else.
+    """
+
+    def __init__(self, max_concurrent: int, max_per_user: int, max_queued: int):
+        # The base class semaphore bounds running + queued updates
+        super().__init__(max_concurrent + max_queued)
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.running = 0
+        self._running_per_user: dict[int, int] = {}
+        self._queues: OrderedDict[int, deque[asyncio.Future]] = OrderedDict()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update: object, coroutine):
+        key = 0
+        if isinstance(update, Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+        try:
+            await self._acquire(key)
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        try:
+            await coroutine
+        finally:
+            self._release(key)
+
+    def _has_room(self, key: int) -> bool:
+        return self.running < self.max_concurrent and self._running_per_user.get(key, 0) < self.max_per_user
+
+    def _start(self, key: int):
+        self.running += 1
+        self._running_per_user[key] = self._running_per_user.get(key, 0) + 1
+
+    async def _acquire(self, key: int):
+        if key not in self._queues and self._has_room(key):
+            self._start(key)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was granted just before the cancellation landed
+                self._release(key)
+            else:
+                queue = self._queues.get(key)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[key]
+            raise
+
+    def _release(self, key: int):
+        self.running -= 1
+        self._running_per_user[key] -= 1
+        if not self._running_per_user[key]:
+            del self._running_per_user[key]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.running < self.max_concurrent:
+            # First user in round-robin order that is below its own cap
+            key = next((k for k in self._queues if self._running_per_user.get(k, 0) < self.max_per_user), None)
+            if key is None:
+                return
+            queue = self._queues[key]
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not waiter.done():
+                self._start(key)
+                waiter.set_result(None)
+
 # === COMMANDS ===
+@traced("start", platform=False)
 async def start(update: Update, context: CallbackContext):
     user = update.effective_user
     await update.message.reply_html(f"""
@@ -117,163 +1839,574 @@ async def start(update: Update, context: CallbackContext):
 <b>Supported Platforms:</b>
 • Instagram • TikTok • Facebook • X (Twitter)
 • YouTube • Spotify • Pinterest • MediaFire • CapCut
+• Threads • SoundCloud
 
-Use /help for command list.
+Send me a link, or use /help for the command list.
     """)
 
+@traced("help", platform=False)
 async def help_command(update: Update, context: CallbackContext):
-    await start(update, context)
+    commands = "\n".join(f"/{p.command} &lt;link&gt; - {p.label}" for p in PLATFORMS.values())
+    await update.message.reply_html(f"<b>Commands</b>\n\n{commands}\n\n/about - Bot statistics")
 
+@traced("about", platform=False)
 async def about(update: Update, context: CallbackContext):
-    uptime = datetime.now() - stats["start_time"]
+    uptime = datetime.now() - stats.start_time
     days = uptime.days
     hours, rem = divmod(uptime.seconds, 3600)
     minutes, _ = divmod(rem, 60)
-    success_rate = (stats["successful_requests"] / max(stats["total_requests"], 1)) * 100
+    success_rate = (stats.successful_requests / max(stats.total_requests, 1)) * 100
     await update.message.reply_html(f"""
 <b>About Bot</b>
 
 <b>Uptime:</b> {days}d {hours}h {minutes}m
-<b>Users:</b> {len(stats["users"])}
-<b>Total Requests:</b> {stats["total_requests"]}
+<b>Users:</b> {stats.user_total}
+<b>Total Requests:</b> {stats.total_requests}
 <b>Success Rate:</b> {success_rate:.1f}%
     """)
 
-# === PLATFORM HANDLERS (100% same as original) ===
-async def handle_instagram(update: Update, context: CallbackContext):
-    user_id = update.effective_user.id
-    on_cd, wait = check_cooldown(context, user_id)
-    if on_cd:
-        await update.message.reply_text(f"⏳ Wait {wait}s before next command.", parse_mode=ParseMode.HTML)
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: <b>/instagram <link></b>", parse_mode=ParseMode.HTML)
-        return
+# === PLATFORM HANDLERS ===
+# File extensions that tell the media type of a link regardless of where it sits in the response
+MEDIA_EXTENSIONS = {
+    ".mp4": "video", ".mov": "video", ".webm": "video", ".mkv": "video",
+    ".jpg": "photo", ".jpeg": "photo", ".png": "photo", ".webp": "photo",
+    ".mp3": "audio", ".m4a": "audio", ".ogg": "audio", ".opus": "audio", ".flac": "audio", ".wav": "audio",
+}
+# Response keys whose links are never the requested media itself
+NON_MEDIA_KEYS = ("thumb", "cover", "avatar", "author", "user", "profile", "preview", "poster", "source", "original", "permalink")
+# Keys under which a link of unknown type is taken to be the platform's default media;
+# any other link without a media extension or type hint is skipped
+MEDIA_KEY_HINTS = ("url", "download", "media", "file")
+TELEGRAM_TEXT_LIMIT = 4096
 
-    msg = await update.message.reply_text("⏳ Processing...")
-    task = asyncio.create_task(loading_animation(msg))
+class Extraction:
+    def __init__(self, items: list[tuple[str, str]] | None = None, caption: str = "", thumbnail: str | None = None,
+                 text: str | None = None, error: str | None = None):
+        self.items = items or []
+        self.caption = caption
+        self.thumbnail = thumbnail
+        self.text = text
+        self.error = error
 
-    try:
-        data = await call_api("insta", context.args[0])
-        if data.get("success") and data.get("urls"):
-            uploaded = 0
-            fallback = []
-            for i, url in enumerate(data["urls"], 1):
-                await msg.edit_text(f"Downloading {i}/{len(data['urls'])}...")
-                sent = await send_media_from_url(update, url, "video" if "mp4" in url else "photo", f"Instagram Media {i}", f"ig_{i}")
-                if sent:
-                    uploaded += 1
-                else:
-                    fallback.append(url)
-            await msg.delete()
-            if fallback:
-                reply = f"✅ {uploaded} sent. Large files:\n" + "\n".join([f"<a href='{u}'>Download {i}</a>" for i, u in enumerate(fallback, 1)])
-                await update.message.reply_html(reply, disable_web_page_preview=True)
-            track_command(user_id, "instagram", True)
+class Platform:
+    """A downloader command: which API endpoint it calls and how to read the answer.
+
+    extract(platform, data, source_url) turns the API response into an Extraction;
+    media_type is assumed for links whose type can't be told from the response, and
+    albums says whether every item of a post is sent or only the first one. Links
+    to any of hosts (or their subdomains) in plain messages go to this platform.
+    query_params names the query parameters that identify the content; the rest are
+    dropped from the canonical URL. None keeps everything but known tracking ones.
+    """
+
+    def __init__(self, command: str, label: str, endpoint: str, extract, hosts: tuple[str, ...] = (),
+                 media_type: str = "video", albums: bool = False, prefix: str | None = None,
+                 query_params: tuple[str, ...] | None = ()):
+        self.command = command
+        self.hosts = hosts
+        self.query_params = query_params
+        self.label = label
+        self.endpoint = endpoint
+        self.extract = extract
+        self.media_type = media_type
+        self.albums = albums
+        self.prefix = prefix or command
+
+def guess_media_type(url: str, key: str, default: str) -> str | None:
+    ext = os.path.splitext(urlsplit(url).path)[1].lower()
+    if ext in MEDIA_EXTENSIONS:
+        return MEDIA_EXTENSIONS[ext]
+    for hint, media_type in (("audio", "audio"), ("image", "photo"), ("photo", "photo"), ("video", "video")):
+        if hint in key:
+            return media_type
+    if any(hint in key for hint in MEDIA_KEY_HINTS):
+        return default
+    return None
+
+def find_media(data, default_type: str, key: str = "") -> list[tuple[str, str]]:
+    if isinstance(data, dict):
+        found = []
+        for k, v in data.items():
+            k = k.lower()
+            if not any(skip in k for skip in NON_MEDIA_KEYS):
+                found.extend(find_media(v, default_type, k))
+        return found
+    if isinstance(data, list):
+        return [item for v in data for item in find_media(v, default_type, key)]
+    if isinstance(data, str) and data.startswith(("http://", "https://")):
+        media_type = guess_media_type(data, key, default_type)
+        return [(data, media_type)] if media_type else []
+    return []
+
+def find_key(data, key: str):
+    # First value stored under key anywhere in the response, depth first
+    if isinstance(data, dict):
+        if data.get(key):
+            return data[key]
+        data = list(data.values())
+    if isinstance(data, list):
+        for v in data:
+            found = find_key(v, key)
+            if found:
+                return found
+    return None
+
+def api_error(data: dict) -> str | None:
+    if not data.get("success"):
+        return str(data.get("error") or data.get("message") or "Not found")
+    return None
+
+def extract_media(platform: Platform, data: dict, source_url: str) -> Extraction:
+    """Generic extractor: every media link in the response, in order, minus duplicates and the post itself."""
+    error = api_error(data)
+    if error:
+        return Extraction(error=error)
+    # source_url is canonical; the API may echo the post back in its own spelling
+    post = canonical_url(source_url)
+    seen = set()
+    items = []
+    for url, media_type in find_media(data, platform.media_type):
+        if canonical_url(url) != post and normalize_url(url) not in seen:
+            seen.add(normalize_url(url))
+            items.append((url, media_type))
+    if not items:
+        return Extraction(error="No media found")
+    title = find_key(data, "title")
+    return Extraction(items, caption=f"<b>{html.escape(str(title))}</b>" if title else "")
+
+def extract_instagram(platform: Platform, data: dict, source_url: str) -> Extraction:
+    if not (data.get("success") and data.get("urls")):
+        return Extraction(error=str(data.get("error", "Unknown")))
+    return Extraction([(url, "video" if "mp4" in url else "photo") for url in data["urls"]])
+
+def extract_tiktok(platform: Platform, data: dict, source_url: str) -> Extraction:
+    if not (data.get("success") and data.get("data")):
+        return Extraction(error=str(data.get("error", "Not found")))
+    video = data["data"][0]
+    title = html.escape(video.get("title", "TikTok Video"))
+    return Extraction([(video["downloadLinks"][0]["link"], "video")], caption=f"<b>{title}</b>", thumbnail=video.get("thumbnail"))
+
+def extract_transcript(platform: Platform, data: dict, source_url: str) -> Extraction:
+    error = api_error(data)
+    if error:
+        return Extraction(error=error)
+    transcript = find_key(data, "transcript") or find_key(data, "text")
+    if isinstance(transcript, list):
+        # Timed segments: [{"text": ..., "start": ...}, ...]
+        transcript = " ".join(s.get("text", "") if isinstance(s, dict) else str(s) for s in transcript)
+    if not transcript:
+        return Extraction(error="No transcript found")
+    return Extraction(text=str(transcript))
+
+PLATFORMS = {p.command: p for p in (
+    Platform("instagram", "Instagram", "insta", extract_instagram, ("instagram.com", "instagr.am"), albums=True, prefix="ig"),
+    Platform("tiktok", "TikTok", "tiktok", extract_tiktok, ("tiktok.com",)),
+    Platform("facebook", "Facebook", "facebook", extract_media, ("facebook.com", "fb.com", "fb.watch"), prefix="fb",
+             query_params=("v", "story_fbid", "fbid", "id")),
+    Platform("x", "X (Twitter)", "x", extract_media, ("x.com", "twitter.com"), albums=True),
+    Platform("youtube", "YouTube", "youtube", extract_media, ("youtube.com", "youtu.be"), prefix="yt", query_params=("v",)),
+    Platform("spotify", "Spotify", "spotify", extract_media, ("spotify.com", "spotify.link"), media_type="audio"),
+    Platform("pinterest", "Pinterest", "pinterest", extract_media, ("pinterest.com", "pin.it"), media_type="photo", albums=True, prefix="pin"),
+    Platform("mediafire", "MediaFire", "mediafire", extract_media, ("mediafire.com",), media_type="document", query_params=None),
+    Platform("capcut", "CapCut", "capcut", extract_media, ("capcut.com",), query_params=None),
+    Platform("threads", "Threads", "threads", extract_media, ("threads.net", "threads.com"), media_type="photo", albums=True),
+    Platform("soundcloud", "SoundCloud", "soundcloud", extract_media, ("soundcloud.com",), media_type="audio"),
+    # Only reachable as a command; a YouTube link means the video
+    Platform("yt_trans", "YouTube transcript", "yt_trans", extract_transcript, query_params=("v",)),
+)}
+
+# Registered domain -> platform. Lookups walk up the host one label at a time, so
+# m.instagram.com and vm.tiktok.com cost two dict probes and no regex
+PLATFORM_HOSTS = {host: p for p in PLATFORMS.values() for host in p.hosts}
+
+def platform_for_url(url: str) -> Platform | None:
+    host = (urlsplit(url).hostname or "").rstrip(".")
+    while host:
+        platform = PLATFORM_HOSTS.get(host)
+        if platform is not None:
+            return platform
+        _, _, host = host.partition(".")
+    return None
+
+# Subdomains that serve the same pages as the bare domain
+MIRROR_PREFIXES = ("www.", "m.", "mobile.", "mbasic.", "web.")
+HOST_ALIASES = {"instagr.am": "instagram.com", "twitter.com": "x.com", "fb.com": "facebook.com", "threads.com": "threads.net"}
+# Hosts whose links are only redirects to the real post
+SHORT_LINK_HOSTS = {"vm.tiktok.com", "vt.tiktok.com", "pin.it", "spotify.link", "on.soundcloud.com", "fb.watch"}
+# Pages a short link may land on instead of the post, by first path segment or subdomain
+NON_POST_PAGES = {
+    "login", "login.php", "accounts", "account", "checkpoint", "consent", "signup", "auth", "challenge",
+    "cookie", "privacy", "recover", "unsupported", "error",
+}
+TRACKING_PARAMS = {
+    "igsh", "igshid", "si", "fbclid", "gclid", "feature", "ref", "ref_src", "ref_url", "s", "t", "_r", "_t",
+    "is_from_webapp", "sender_device", "sender_web_id", "share_id", "share_app_id", "mibextid", "context",
+}
+
+def canonical_url(url: str) -> str:
+    """The form of a post URL used everywhere as its identity, without any network access.
+
+    Hosts lose mirror prefixes and aliases, the fragment and trailing slash go, and
+    only the query parameters the platform needs are kept, sorted.
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").rstrip(".")
+    for prefix in MIRROR_PREFIXES:
+        if host.startswith(prefix) and host[len(prefix):] in PLATFORM_HOSTS:
+            host = host[len(prefix):]
+            break
+    host = HOST_ALIASES.get(host, host)
+    platform = PLATFORM_HOSTS.get(host) or platform_for_url(f"https://{host}")
+    if platform is None:
+        return normalize_url(url)
+    path = parts.path.rstrip("/") or "/"
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if host == "youtu.be" and path != "/":
+        host, query, path = "youtube.com", [("v", path[1:])], "/watch"
+    if platform.query_params is None:
+        query = [(k, v) for k, v in query if k.lower() not in TRACKING_PARAMS and not k.lower().startswith("utm_")]
+    else:
+        query = [(k, v) for k, v in query if k in platform.query_params]
+    return urlunsplit(("https", host, path, urlencode(sorted(query)), ""))
+
+def is_post_url(url: str) -> bool:
+    parts = urlsplit(url)
+    first = parts.path.strip("/").split("/")[0].lower()
+    subdomain = (parts.hostname or "").split(".")[0]
+    return bool(first) and first not in NON_POST_PAGES and subdomain not in NON_POST_PAGES
+
+async def resolve_short_link(url: str) -> str:
+    # Only the redirect chain is needed: the response body is never read
+    async with media_client.stream("GET", url, timeout=SHORT_LINK_TIMEOUT) as response:
+        return str(response.url)
+
+async def canonicalize(url: str) -> str:
+    """canonical_url, with short links first followed to the post they point at (cached)."""
+    url = canonical_url(url)
+    if urlsplit(url).hostname not in SHORT_LINK_HOSTS:
+        return url
+    with trace_span("resolve_short_link") as span:
+        resolved = short_link_cache.get(url)
+        span.attrs["cached"] = resolved is not None
+        if resolved is not None:
+            return resolved
+        try:
+            target = canonical_url(await link_flight.do(url, lambda: resolve_short_link(url)))
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            # The API may still manage with the short link itself
+            logger.info(f"Short link {url} not resolved: {e}")
+            return url
+        # A redirect to a login, consent or home page doesn't identify the post; the
+        # short link is kept (and not cached) so the API can still try it
+        if platform_for_url(target) is not platform_for_url(url) or not is_post_url(target):
+            logger.info(f"Short link {url} led to {target}, not a post")
+            return url
+        short_link_cache.set(url, target)
+        return target
+
+def fallback_links(urls: list[str]) -> str:
+    if len(urls) == 1:
+        return f"<a href='{html.escape(urls[0])}'>Download here</a>"
+    return "\n".join(f"<a href='{html.escape(u)}'>Download {i}</a>" for i, u in enumerate(urls, 1))
+
+async def send_items(platform: Platform, update: Update, result: Extraction, source_url: str, progress: ProgressReporter) -> tuple[int, list[str]]:
+    items = result.items if platform.albums else result.items[:1]
+    caption = result.caption or f"{platform.label} Media"
+    if len(items) == 1:
+        url, media_type = items[0]
+        if platform.albums:
+            sent = await send_media_from_url(update, url, media_type, f"{caption} 1", f"{platform.prefix}_1", source_url, 1, progress)
         else:
-            await msg.edit_text(f"Error: {data.get('error', 'Unknown')}")
-            track_command(user_id, "instagram", False)
-    except Exception as e:
-        await msg.edit_text("Unexpected error.")
-        logger.error(f"Instagram error: {e}")
-    finally:
-        task.cancel()
+            # Files keep their own name and extension
+            prefix = (os.path.basename(urlsplit(url).path) or platform.prefix) if media_type == "document" else platform.prefix
+            sent = await send_media_from_url(update, url, media_type, caption, prefix, source_url, progress=progress)
+        return (1, []) if sent else (0, [url])
+    if all(media_type in ("photo", "video") for _, media_type in items):
+        return await send_media_group_from_urls(update, items, source_url, caption, platform.prefix, progress)
+    # Audio and files can't share an album with photos and videos
+    uploaded, fallback = 0, []
+    for i, (url, media_type) in enumerate(items, 1):
+        progress.set_stage(f"Downloading {i}/{len(items)}")
+        if await send_media_from_url(update, url, media_type, f"{caption} {i}", f"{platform.prefix}_{i}", source_url, i, progress):
+            uploaded += 1
+        else:
+            fallback.append(url)
+    return uploaded, fallback
 
-# (All other handlers — tiktok, facebook, youtube, etc. — are 100% identical to your original)
-# I’m including only a few here to avoid message limit, but in the real file they are ALL present:
-# handle_facebook, handle_tiktok, handle_x, handle_youtube, handle_spotify, handle_pinterest,
-# handle_mediafire, handle_capcut, handle_soundcloud, handle_threads, handle_yt_trans
+async def send_text(update: Update, text: str, filename: str):
+    if len(text) <= TELEGRAM_TEXT_LIMIT:
+        await update.message.reply_text(text)
+    else:
+        await update.message.reply_document(InputFile(text.encode(), filename=filename))
 
-# Example: TikTok handler (same as original)
-async def handle_tiktok(update: Update, context: CallbackContext):
+async def run_platform(platform: Platform, update: Update, source_url: str | None):
+    """The shared command flow: rate limit, look up the link, send what came back."""
     user_id = update.effective_user.id
-    on_cd, wait = check_cooldown(context, user_id)
-    if on_cd:
-        await update.message.reply_text(f"⏳ Wait {wait}s.", parse_mode=ParseMode.HTML)
+    limited, wait = check_rate_limit(user_id, platform.command)
+    if limited:
+        await update.message.reply_text(f"⏳ Wait {wait}s before next command.", parse_mode=ParseMode.HTML)
         return
-    if not context.args:
-        await update.message.reply_text("Usage: <b>/tiktok <link></b>", parse_mode=ParseMode.HTML)
+    if not source_url:
+        await update.message.reply_text(f"Usage: <b>/{platform.command} &lt;link&gt;</b>", parse_mode=ParseMode.HTML)
         return
 
     msg = await update.message.reply_text("⏳ Processing...")
-    task = asyncio.create_task(loading_animation(msg))
+    progress = ProgressReporter(msg)
     try:
-        data = await call_api("tiktok", context.args[0])
-        if data.get("success") and data.get("data"):
-            video = data["data"][0]
-            dl = video["downloadLinks"][0]["link"]
-            caption = f"<b>{video.get('title', 'TikTok Video')}</b>"
-            if video.get("thumbnail"):
-                await update.message.reply_photo(video["thumbnail"])
-            sent = await send_media_from_url(update, dl, "video", caption, "tiktok")
-            if sent:
-                await msg.delete()
-                track_command(user_id, "tiktok", True)
-            else:
-                await msg.edit_text(f"Too large. <a href='{dl}'>Download here</a>", disable_web_page_preview=True)
-                track_command(user_id, "tiktok", False)
-        else:
-            await msg.edit_text(f"Error: {data.get('error', 'Not found')}")
+        source_url = await canonicalize(source_url)
+        result = platform.extract(platform, await call_api(platform.endpoint, source_url), source_url)
+        if result.error:
+            await progress.done(f"Error: {html.escape(result.error)}", parse_mode=ParseMode.HTML)
+            track_command(user_id, platform.command, False)
+            return
+        if result.text is not None:
+            await progress.done()
+            await send_text(update, result.text, f"{platform.prefix}.txt")
+            track_command(user_id, platform.command, True)
+            return
+        if result.thumbnail:
+            with trace_span("send", media_type="thumbnail"):
+                await update.message.reply_photo(result.thumbnail)
+        uploaded, fallback = await send_items(platform, update, result, source_url, progress)
+        if not uploaded:
+            await progress.done(f"Too large. {fallback_links(fallback)}", parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            track_command(user_id, platform.command, False)
+            return
+        await progress.done()
+        if fallback:
+            await update.message.reply_html(f"✅ {uploaded} sent. Large files:\n{fallback_links(fallback)}", disable_web_page_preview=True)
+        track_command(user_id, platform.command, True)
     except Exception as e:
-        await msg.edit_text("Error occurred.")
-        logger.error(e)
+        await progress.done("Unexpected error.")
+        logger.error(f"{platform.label} error: {e}")
+        track_command(user_id, platform.command, False)
     finally:
-        task.cancel()
+        progress.stop()
+
+def platform_handler(platform: Platform):
+    # As a command handler the link comes from the command; handle_links passes it in
+    async def handler(update: Update, context: CallbackContext, source_url: str | None = None):
+        await run_platform(platform, update, source_url or (context.args[0] if context.args else None))
+    handler.__name__ = handler.__qualname__ = f"handle_{platform.command}"
+    return traced(platform.command)(handler)
+
+PLATFORM_HANDLERS = {command: platform_handler(p) for command, p in PLATFORMS.items()}
+
+def message_links(message: Message) -> list[str]:
+    # Telegram has already found the links; text links carry their target separately
+    links = []
+    for entity, text in message.parse_entities([MessageEntityType.URL, MessageEntityType.TEXT_LINK]).items():
+        url = entity.url if entity.type == MessageEntityType.TEXT_LINK else text
+        links.append(url if "://" in url else f"https://{url}")
+    return links
+
+async def handle_links(update: Update, context: CallbackContext):
+    """Plain messages with supported links are handled as if each link came with its command."""
+    jobs = []
+    seen = set()
+    for url in message_links(update.message):
+        platform = platform_for_url(url)
+        if platform is not None and canonical_url(url) not in seen:
+            seen.add(canonical_url(url))
+            jobs.append((platform, url))
+    if not jobs:
+        await update.message.reply_text("No supported link found. See /help for the supported platforms.")
+        return
+    if len(jobs) > LINKS_PER_MESSAGE:
+        await update.message.reply_text(f"Only the first {LINKS_PER_MESSAGE} links are handled.")
+        jobs = jobs[:LINKS_PER_MESSAGE]
+    # One after another: the message holds a single scheduler slot, and running its
+    # links side by side would get around the per-user and global caps.
+    # Each still gets its own rate limit check and request id.
+    for platform, url in jobs:
+        await PLATFORM_HANDLERS[platform.command](update, context, url)
 
 # === ADMIN COMMANDS (no owner name) ===
+@traced("stats", platform=False)
 async def stats_command(update: Update, context: CallbackContext):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("Admin only.")
         return
-    # ... full stats same as original
+    scheduler = context.application.update_processor
+    top = sorted(stats.commands.items(), key=lambda kv: kv[1], reverse=True)[:10]
+    commands = "\n".join(f"• /{cmd}: {count}" for cmd, count in top) or "—"
+    await update.message.reply_html(f"""
+<b>Bot Statistics</b>
+
+<b>Users:</b> {stats.user_total}
+<b>Total Requests:</b> {stats.total_requests}
+<b>Successful:</b> {stats.successful_requests}
+<b>Failed:</b> {stats.failed_requests}
+
+<b>Top Commands:</b>
+{commands}
+
+<b>File ID Cache:</b> {len(file_id_cache)}/{file_id_cache.max_entries} entries
+<b>Hits/Misses:</b> {file_id_cache.hits}/{file_id_cache.misses} ({file_id_cache.hit_ratio() * 100:.1f}%)
+<b>API Cache:</b> {len(api_cache)}/{api_cache.max_entries} entries
+<b>Hits/Misses:</b> {api_cache.hits}/{api_cache.misses} ({api_cache.hit_ratio() * 100:.1f}%)
+<b>Short Links:</b> {len(short_link_cache)} resolved, {short_link_cache.hit_ratio() * 100:.1f}% hits
+
+<b>Updates Running:</b> {scheduler.running}/{scheduler.max_concurrent}
+<b>Updates Queued:</b> {scheduler.queue_depth}
+<b>Transfer Budget:</b> {transfer_budget.reserved / 1048576:.1f}/{transfer_budget.capacity / 1048576:.0f} MB ({transfer_budget.utilization() * 100:.0f}%)
+<b>Transfers Waiting:</b> {transfer_budget.waiting}
+    """)
 
+@traced("broadcast", platform=False)
 async def broadcast(update: Update, context: CallbackContext):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("Admin only.")
         return
     if not context.args:
-        await update.message.reply_text("Usage: /broadcast <message>")
+        await update.message.reply_text("Usage: /broadcast <message>\n/broadcast stop - cancel the running broadcast")
+        return
+    if context.args == ["stop"]:
+        if current_broadcast is None:
+            await update.message.reply_text("No broadcast is running.")
+            return
+        job = current_broadcast
+        broadcast_task.cancel()
+        await asyncio.wait([broadcast_task])
+        await job.cancel()
+        await update.message.reply_text(f"Broadcast stopped. Sent: {job.sent}, Failed: {job.failed}, Blocked: {job.blocked}")
+        return
+    if current_broadcast is not None:
+        await update.message.reply_text("A broadcast is already running. Use /broadcast stop to cancel it.")
+        return
+    # Keep the text's line breaks; context.args would collapse them
+    msg_text = update.message.text.split(maxsplit=1)[1]
+    status = await update.message.reply_text("📣 Broadcasting...")
+    await stats.flush()
+    start_broadcast(await Broadcast.create(msg_text, status.chat_id, status.message_id), context.bot)
+
+@traced("adminhelp", platform=False)
+async def adminhelp(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("Admin only.")
         return
-    msg_text = " ".join(context.args)
-    sent = failed = 0
-    status = await update.message.reply_text("Sending...")
-    for uid in stats["users"]:
+    await update.message.reply_html("""
+<b>Admin Commands</b>
+
+/stats - Usage, cache and queue statistics
+/broadcast &lt;message&gt; - Send a message to every user
+/broadcast stop - Cancel the running broadcast
+    """)
+
+# === WEB SERVER ===
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, app: Application):
+        self.app = app
+
+    async def post(self):
+        token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            raise tornado.web.HTTPError(403)
         try:
-            await context.bot.send_message(uid, f"<b>Announcement</b>\n\n{msg_text}", parse_mode=ParseMode.HTML)
-            sent += 1
-            await asyncio.sleep(0.05)
-        except:
-            failed += 1
-    await status.edit_text(f"Done! Sent: {sent}, Failed: {failed}")
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
+        except (ValueError, TypeError, AttributeError):
+            # Not JSON, or JSON that isn't an update object (de_json fails on e.g. [1])
+            raise tornado.web.HTTPError(400)
+        if update is None:
+            # {} and null parse to nothing
+            raise tornado.web.HTTPError(400)
+        # Acknowledge right away; the Application processes the queue on its own
+        await self.app.update_queue.put(update)
 
-# === MAIN ===
-\def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("ok")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.write(generate_latest(REGISTRY))
+
+def build_web_app(app: Application) -> tornado.web.Application:
+    routes = [("/healthz", HealthHandler), ("/metrics", MetricsHandler)]
+    if WEBHOOK_URL:
+        routes.append((WEBHOOK_PATH, WebhookHandler, {"app": app}))
+    return tornado.web.Application(routes)
+
+async def serve(app: Application):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
 
+    REGISTRY.register(BotCollector(app))
+    async with app:
+        await post_init(app)
+        if WEBHOOK_URL:
+            # Every replica registers the same URL; the webhook is deliberately not
+            # deleted on shutdown so a rolling restart doesn't cut the others off
+            await app.bot.set_webhook(
+                url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await app.start()
+        server = build_web_app(app).listen(PORT)
+        logger.info(f"Serving on port {PORT} ({'webhook' if WEBHOOK_URL else 'polling'} mode)")
+        try:
+            await stop.wait()
+        finally:
+            server.stop()
+            # Each step runs even if the one before raised: post_shutdown writes the
+            # pending stats, cache changes and request log batch
+            try:
+                if app.updater is not None and app.updater.running:
+                    await app.updater.stop()
+            finally:
+                try:
+                    await app.stop()
+                finally:
+                    await post_shutdown(app)
+
+# === MAIN ===
+def register_handlers(app: Application):
     # Commands
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("about", about))
-    app.add_handler(CommandHandler("instagram", handle_instagram))
-    app.add_handler(CommandHandler("tiktok", handle_tiktok))
-    app.add_handler(CommandHandler("facebook", handle_facebook))
-    app.add_handler(CommandHandler("x", handle_x))
-    app.add_handler(CommandHandler("youtube", handle_youtube))
-    app.add_handler(CommandHandler("spotify", handle_spotify))
-    app.add_handler(CommandHandler("pinterest", handle_pinterest))
-    app.add_handler(CommandHandler("mediafire", handle_mediafire))
-    app.add_handler(CommandHandler("capcut", handle_capcut))
-    app.add_handler(CommandHandler("threads", handle_threads))
-    app.add_handler(CommandHandler("soundcloud", handle_soundcloud))
-    app.add_handler(CommandHandler("yt_trans", handle_yt_trans))
+    for command, handler in PLATFORM_HANDLERS.items():
+        app.add_handler(CommandHandler(command, handler))
+    # Bare links in private chats; in groups only commands are answered
+    app.add_handler(MessageHandler(
+        filters.ChatType.PRIVATE & ~filters.COMMAND
+        & (filters.Entity(MessageEntityType.URL) | filters.Entity(MessageEntityType.TEXT_LINK)),
+        handle_links,
+    ))
 
     # Admin commands
     app.add_handler(CommandHandler("stats", stats_command))
     app.add_handler(CommandHandler("broadcast", broadcast))
     app.add_handler(CommandHandler("adminhelp", adminhelp))
 
+def build_application(polling: bool = True) -> Application:
+    """The configured application with every handler registered; without polling there is no updater."""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{BOT_API_URL}/bot")
+        .base_file_url(f"{BOT_API_URL}/file/bot")
+        .rate_limiter(OutboundLimiter(
+            OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE_PER_MINUTE, OUTBOUND_MAX_RETRIES
+        ))
+        .concurrent_updates(FairScheduler(MAX_CONCURRENT_UPDATES, MAX_CONCURRENT_PER_USER, MAX_QUEUED_UPDATES))
+    )
+    if not polling:
+        builder = builder.updater(None)
+    app = builder.build()
+    register_handlers(app)
+    return app
+
+def main():
+    app = build_application(polling=not WEBHOOK_URL)
     logger.info("Bot starting...")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    asyncio.run(serve(app))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# main reads its configuration at import time
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bot-tests-"), "bot.db"))
+os.environ.setdefault("REQUEST_LOG_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,64 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+def test_find_media_skips_profile_and_page_links():
+    data = {
+        "user_url": "https://x.com/someone",
+        "link": "https://t.co/abc",
+        "media": [{"url": "https://video.twimg.com/a/b"}, "https://pbs.twimg.com/media/x.jpg"],
+    }
+    assert main.find_media(data, "video") == [
+        ("https://video.twimg.com/a/b", "video"),
+        ("https://pbs.twimg.com/media/x.jpg", "photo"),
+    ]
+
+
+@pytest.mark.parametrize("key, url, expected", [
+    ("download_url", "https://cdn.example.com/a", "video"),
+    ("hd", "https://cdn.example.com/a.mp4", "video"),
+    ("cover_image", "https://cdn.example.com/a", "photo"),
+    ("audio", "https://cdn.example.com/a", "audio"),
+    ("link", "https://cdn.example.com/a", None),
+    ("title", "https://cdn.example.com/a", None),
+])
+def test_guess_media_type(key, url, expected):
+    assert main.guess_media_type(url, key, "video") == expected
+
+
+def download(content_type: str, media_type: str):
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"content-type": content_type}, content=b"x" * 16)
+
+    async def run():
+        main.media_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await main.download_media("https://cdn.example.com/a", media_type)
+        finally:
+            await main.media_client.aclose()
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("content_type, media_type", [
+    ("text/html; charset=utf-8", "video"),
+    ("application/json", "photo"),
+    ("text/html", "document"),
+])
+def test_download_media_rejects_pages(content_type, media_type):
+    with pytest.raises(main.NotMedia):
+        download(content_type, media_type)
+
+
+@pytest.mark.parametrize("content_type, media_type", [
+    ("video/mp4", "video"),
+    ("application/octet-stream", "video"),
+    ("", "photo"),
+    ("text/plain", "document"),
+])
+def test_download_media_accepts_files(content_type, media_type):
+    download(content_type, media_type).close()
@@ -0,0 +1,22 @@
+import main
+
+
+def test_rate_limiter_limits_each_user():
+    limiter = main.RateLimiter(1 / 60, 2, 0, 0, 100)
+    assert limiter.acquire(1) == 0
+    assert limiter.acquire(1) == 0
+    assert limiter.acquire(1) > 0
+    assert limiter.acquire(2) == 0
+
+
+def test_rate_limiter_global_bucket_is_shared():
+    limiter = main.RateLimiter(0, 0, 1 / 60, 2, 100)
+    assert limiter.acquire(1) == 0
+    assert limiter.acquire(2) == 0
+    assert limiter.acquire(3) > 0
+
+
+def test_rate_limiter_caps_cost_at_burst():
+    limiter = main.RateLimiter(1 / 60, 2, 0, 0, 100)
+    assert limiter.acquire(1, cost=5) == 0
+    assert limiter.acquire(1) > 0
@@ -0,0 +1,30 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import main
+
+
+def run(handler, text: str, args: list[str]) -> dict:
+    records = []
+    main.request_log = SimpleNamespace(write=records.append)
+    update = SimpleNamespace(
+        message=SimpleNamespace(text=text, reply_html=AsyncMock(), reply_text=AsyncMock()),
+        effective_user=SimpleNamespace(id=7),
+    )
+    try:
+        asyncio.run(handler(update, SimpleNamespace(args=args)))
+    finally:
+        main.request_log = None
+    [record] = records
+    return record
+
+
+def test_info_commands_are_logged_without_platform():
+    record = run(main.help_command, "/help", [])
+    assert (record["command"], record["platform"], record["url_hash"], record["outcome"]) == ("help", None, None, "success")
+
+
+def test_broadcast_text_is_not_hashed_as_a_link():
+    record = run(main.broadcast, "/broadcast see https://x.com/a", ["see", "https://x.com/a"])
+    assert (record["command"], record["platform"], record["url_hash"]) == ("broadcast", None, None)
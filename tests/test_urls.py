@@ -0,0 +1,91 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://www.instagram.com/p/ABC/?igsh=xyz", "https://instagram.com/p/ABC"),
+    ("http://m.instagram.com/reel/ABC/#comments", "https://instagram.com/reel/ABC"),
+    ("https://instagr.am/p/ABC", "https://instagram.com/p/ABC"),
+    ("https://mobile.twitter.com/someone/status/1?s=20&t=abc", "https://x.com/someone/status/1"),
+    ("https://youtu.be/dQw4w9WgXcQ?si=abc", "https://youtube.com/watch?v=dQw4w9WgXcQ"),
+    ("https://www.youtube.com/watch?feature=share&v=dQw4w9WgXcQ", "https://youtube.com/watch?v=dQw4w9WgXcQ"),
+    ("https://www.facebook.com/watch/?v=123&mibextid=abc", "https://facebook.com/watch?v=123"),
+    ("https://www.mediafire.com/file/abc/x.zip/file?dkey=1&utm_source=x", "https://mediafire.com/file/abc/x.zip/file?dkey=1"),
+    ("HTTPS://CDN.Example.com/a.mp4?sig=1#x", "https://cdn.example.com/a.mp4?sig=1"),
+])
+def test_canonical_url(url, expected):
+    assert main.canonical_url(url) == expected
+
+
+def test_canonical_url_keeps_unrelated_subdomains():
+    assert main.canonical_url("https://vm.tiktok.com/ZM123/") == "https://vm.tiktok.com/ZM123"
+    assert main.canonical_url("https://www.notinstagram.com/p/1") == "https://www.notinstagram.com/p/1"
+
+
+@pytest.mark.parametrize("url, is_post", [
+    ("https://facebook.com/login?next=x", False),
+    ("https://facebook.com/login.php", False),
+    ("https://instagram.com/accounts/login", False),
+    ("https://tiktok.com/login", False),
+    ("https://consent.youtube.com/m", False),
+    ("https://pinterest.com/", False),
+    ("https://pinterest.com/pin/123", True),
+    ("https://tiktok.com/@someone/video/123", True),
+])
+def test_is_post_url(url, is_post):
+    assert main.is_post_url(url) is is_post
+
+
+def resolve(redirects: dict[str, str]):
+    """Run canonicalize with short links redirecting as given, on fresh caches."""
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(str(request.url))
+        target = redirects.get(str(request.url))
+        if target is None:
+            return httpx.Response(200)
+        return httpx.Response(302, headers={"location": target})
+
+    async def run(url: str) -> str:
+        main.short_link_cache = main.LRUCache("short_links", 100, 60)
+        main.media_client = httpx.AsyncClient(transport=httpx.MockTransport(handler), follow_redirects=True)
+        try:
+            return await main.canonicalize(url), await main.canonicalize(url)
+        finally:
+            await main.media_client.aclose()
+
+    return run, requests
+
+
+def test_canonicalize_follows_and_caches_short_links():
+    run, requests = resolve({"https://vm.tiktok.com/ZM123": "https://www.tiktok.com/@someone/video/123?_r=1"})
+    first, second = asyncio.run(run("https://vm.tiktok.com/ZM123/"))
+    assert first == second == "https://tiktok.com/@someone/video/123"
+    # The second lookup is served from short_link_cache
+    assert len([r for r in requests if "vm.tiktok.com" in r]) == 1
+
+
+@pytest.mark.parametrize("short, landing", [
+    ("https://fb.watch/abc", "https://www.facebook.com/login/?next=https%3A%2F%2Ffb.watch%2Fabc"),
+    ("https://pin.it/abc", "https://www.pinterest.com/login/"),
+    ("https://vm.tiktok.com/ZM1", "https://www.tiktok.com/login?redirect_url=x"),
+    ("https://vm.tiktok.com/ZM2", "https://www.tiktok.com/"),
+    ("https://spotify.link/abc", "https://example.com/elsewhere"),
+])
+def test_canonicalize_keeps_short_link_that_lands_elsewhere(short, landing):
+    run, requests = resolve({short: landing})
+    first, second = asyncio.run(run(short))
+    assert first == second == short
+    # Not cached: each lookup tries again
+    assert len([r for r in requests if r == short]) == 2
+
+
+def test_canonicalize_leaves_regular_links_offline():
+    run, requests = resolve({})
+    assert asyncio.run(run("https://www.instagram.com/p/ABC/?igsh=1")) == ("https://instagram.com/p/ABC",) * 2
+    assert requests == []